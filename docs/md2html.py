@@ -14,10 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import html
+import json
 import markdown
+import os
 import re
-import sys
 import textwrap
 
 from markdown.preprocessors import Preprocessor
@@ -28,11 +32,18 @@ IAA = '\uFFF9'  # IAA (INTERLINEAR ANNOTATION ANCHOR)
 IAS = '\uFFFA'  # IAS (INTERLINEAR ANNOTATION SEPARATOR)
 IAT = '\uFFFB'  # IAT (INTERLINEAR ANNOTATION TERMINATOR)
 
-title = ''
+# The links of the pages built last time by --batch, to tell if a page has
+# to be rebuilt for its new neighbors.
+STAMP = '.md2html.json'
+
+md = None           # the Markdown instance of this process
+extension = None    # the MyExtension of md
 
 
 class MyPreprocessor(Preprocessor):
 
+    title = ''
+
     def strip_ruby(self, line):
         br = line.find('<br>')
         if 0 <= br:
@@ -47,7 +58,6 @@ class MyPreprocessor(Preprocessor):
         return line
 
     def run(self, lines):
-        global title
         tr = str.maketrans({
             IAA: '<ruby>',
             IAS: '<rp>(</rp><rt>',
@@ -59,7 +69,7 @@ class MyPreprocessor(Preprocessor):
             if line:
                 if line.startswith("# "):
                     title = line[2:].strip(' \n\r')
-                    title = self.strip_ruby(title)
+                    self.title = self.strip_ruby(title)
                 line = line.translate(tr)
                 if line.startswith("```"):
                     pre = pre ^ True
@@ -80,45 +90,47 @@ class MyExtension(Extension):
 
     def extendMarkdown(self, md, md_globals):
         # Insert code here to change markdown's behavior.
-        md.preprocessors.add('my', MyPreprocessor(md), '_begin')
-
+        self.preprocessor = MyPreprocessor(md)
+        md.preprocessors.add('my', self.preprocessor, '_begin')
+
+
+# Return the Markdown instance of this process, which is reset for each page
+# instead of being created again with all the extensions.
+def get_markdown():
+    global md, extension
+    if md is None:
+        extension = MyExtension()
+        md = markdown.Markdown(extensions=[extension,
+                                           'markdown.extensions.meta',
+                                           'markdown.extensions.sane_lists',
+                                           'markdown.extensions.tables',
+                                           'markdown.extensions.extra',
+                                           'markdown.extensions.attr_list'],
+                               output_format='html5')
+    md.reset()
+    extension.preprocessor.title = ''
+    return md
+
+
+@functools.lru_cache()
+def read_template(path):
+    with open(path) as file:
+        return file.read()
 
-def main():
-    global title
 
-    if len(sys.argv) < 2:
-        print('Usage: md2html path/to/file prev next [template]',
-              file=sys.stderr)
-        sys.exit(1)
+def get_html_path(path):
+    return path[:-2] + 'html'
 
-    prev_url = next_url = ''
-    if 4 <= len(sys.argv):
-        prev_url = sys.argv[2][:-2] + 'html'
-        next_url = sys.argv[3][:-2] + 'html'
-
-    path = 'template.html'
-    if 5 <= len(sys.argv):
-        path = sys.argv[4]
-    template = ''
-    with open(path) as file:
-        for line in file:
-            template += line
 
-    path = sys.argv[1]
-    source = ''
+# Convert the Markdown file at path into the HTML file next to it.
+def convert(path, prev_url='', next_url='', template_path='template.html'):
+    template = read_template(template_path)
     with open(path) as file:
-        for line in file:
-            source += line
-
-    md = markdown.Markdown(extensions=[MyExtension(),
-                                       'markdown.extensions.meta',
-                                       'markdown.extensions.sane_lists',
-                                       'markdown.extensions.tables',
-                                       'markdown.extensions.extra',
-                                       'markdown.extensions.attr_list'],
-                           output_format='html5')
+        source = file.read()
 
+    md = get_markdown()
     body = md.convert(source)
+    title = extension.preprocessor.title
     description = title
     og_image = 'https://esrille.github.io/ibus-hiragana/screenshot.png'
     if 'summary' in md.Meta:
@@ -131,7 +143,7 @@ def main():
     if 'og_image' in md.Meta:
         og_image = md.Meta['og_image'][0]
 
-    path = path[:-2] + 'html'
+    path = get_html_path(path)
     content = textwrap.dedent(
         template.format(body=body,
                         title=html.escape(title),
@@ -147,6 +159,79 @@ def main():
 
     with open(path, 'w') as file:
         file.write(content)
+    return path
+
+
+def _convert(job):
+    return convert(*job)
+
+
+# Return True if the HTML file of path is newer than its source, the
+# template and this script, and links to the same neighbors as before.
+def is_up_to_date(path, links, template_path, stamps):
+    output = get_html_path(path)
+    if stamps.get(output) != list(links):
+        return False
+    try:
+        built = os.stat(output).st_mtime_ns
+        return all(os.stat(source).st_mtime_ns <= built for source in (path, template_path, __file__))
+    except OSError:
+        return False
+
+
+# Convert the Markdown files in paths in a pool of processes. Each page is
+# linked to its neighbors in paths as a ring, and is skipped unless it has
+# been changed since the last build.
+def build(paths, template_path='template.html', jobs=None, force=False):
+    stamps = dict()
+    if not force:
+        try:
+            with open(STAMP) as file:
+                stamps = json.load(file)
+        except (OSError, ValueError):
+            pass
+    jobs_to_run = list()
+    links = dict()
+    for i, path in enumerate(paths):
+        prev_url = get_html_path(paths[i - 1])
+        next_url = get_html_path(paths[(i + 1) % len(paths)])
+        links[get_html_path(path)] = [prev_url, next_url]
+        if force or not is_up_to_date(path, (prev_url, next_url), template_path, stamps):
+            jobs_to_run.append((path, prev_url, next_url, template_path))
+    if jobs_to_run:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for output in executor.map(_convert, jobs_to_run):
+                print(output)
+    stamps.update(links)
+    with open(STAMP, 'w') as file:
+        json.dump(stamps, file, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s path/to/file prev next [template]\n'
+              '       %(prog)s --batch [-j JOBS] [-t template] [-f] file...')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='convert the files in one process pool, linking each to its neighbors')
+    parser.add_argument('-f', '--force', action='store_true', help='convert the files even if up to date')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='the number of processes')
+    parser.add_argument('-t', '--template', default='template.html', help='the template file')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    if args.batch:
+        build(args.files, args.template, args.jobs, args.force)
+        return
+
+    files = args.files
+    prev_url = next_url = ''
+    if 3 <= len(files):
+        prev_url = get_html_path(files[1])
+        next_url = get_html_path(files[2])
+    template_path = args.template
+    if 4 <= len(files):
+        template_path = files[3]
+    convert(files[0], prev_url, next_url, template_path)
 
 
 if __name__ == '__main__':
@@ -18,8 +18,10 @@ import package
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gio, Gtk, Gdk
+from gi.repository import Gio, GLib, Gtk, Gdk
 
+import ime
+import startup
 from window import TypingWindow
 
 import gettext
@@ -41,17 +43,31 @@ class Application(Gtk.Application):
             **kwargs
         )
         self.window = None
+        self.add_main_option("ime", 0, GLib.OptionFlags.NONE, GLib.OptionArg.STRING,
+                             _("Input method backend: ibus or simulator"), "BACKEND")
+        self.add_main_option("ime-script", 0, GLib.OptionFlags.NONE, GLib.OptionArg.FILENAME,
+                             _("Keys to type with the simulator"), "FILE")
 
     def do_activate(self):
         if not self.window:
             filename = os.path.join(package.get_datadir(), 'lessons/menu.txt')
             self.window = TypingWindow(application=self, filename=filename)
+            startup.mark('window')
             self.cursor = Gdk.Cursor.new_from_name(self.window.get_display(), "default")
         self.window.present()
 
+    def do_handle_local_options(self, options):
+        backend = options.lookup_value("ime", GLib.VariantType.new("s"))
+        script = options.lookup_value("ime-script", GLib.VariantType.new("ay"))
+        if backend or script:
+            ime.set_backend(backend.get_string() if backend else 'simulator',
+                            script.get_bytestring().decode() if script else '')
+        return -1
+
     def do_open(self, files, *hint):
         if not self.window:
             self.window = TypingWindow(application=self, filename=files[0].get_path())
+            startup.mark('window')
             self.cursor = Gdk.Cursor.new_from_name(self.window.get_display(), "default")
         self.window.present()
 
@@ -70,6 +86,7 @@ class Application(Gtk.Application):
         self.set_accels_for_action("app.help", ["F1"])
         self.set_accels_for_action("win.menu", ["F10"])
         self.set_accels_for_action("app.quit", ["<Primary>q"])
+        startup.mark('application startup')
 
     def do_window_removed(self, window):
         logger.info('do_window_removed')
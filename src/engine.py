@@ -14,15 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from hurigana import get_plain_text
+from lesson import BUNDLE_NAME, LessonCatalog, get_bundle_name, get_plain_text, get_texts, open_bundle, split_lines
 import package
 
 import gi
+gi.require_version('Gdk', '3.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
-from gi.repository import Gdk
+from gi.repository import Gdk, Gio, GLib
 
+from collections import OrderedDict
 import operator
 from datetime import date, datetime
 from enum import Enum
@@ -36,7 +38,10 @@ import ime
 logger = logging.getLogger(__name__)
 
 DELAY_FINISH = 1.0    # [seconds]
+MAX_PROFILES = 4
 MAX_STATS_DAYS = 366 / 2
+MIN_ACCURACY = 0.85
+MIN_WPM = 5
 TIME_OVER = 59 * 60   # [seconds]
 
 ZENKAKU = ''.join(chr(i) for i in range(0xff01, 0xff5f)) + '　￥'
@@ -54,6 +59,21 @@ def to_hankaku(s: str):
     return s.translate(TO_HANKAKU)
 
 
+"""
+3rd: 15 wpm, 85% accuracy
+5th: 30 wpm
+"""
+def get_score(wpm, accuracy, min_accuracy=MIN_ACCURACY, min_wpm=MIN_WPM):
+    accuracy += min_accuracy
+    if 1 < accuracy:
+        accuracy = 1
+    wpm *= accuracy
+    score = int(wpm / min_wpm)
+    if 10 < score:
+        score = 10
+    return score
+
+
 class EngineMode(Enum):
     RUN = 1
     MENU = 2
@@ -63,11 +83,13 @@ class EngineMode(Enum):
     SCORE = 6
     STATS = 7
     EXIT = 8
+    LOADING = 9
 
 
 class Stats:
-    def __init__(self):
-        datadir = package.get_user_datadir()
+    def __init__(self, datadir=''):
+        if not datadir:
+            datadir = package.get_user_datadir()
         os.makedirs(datadir, 0o700, True)
         os.chmod(datadir, 0o700)
         self.filename = os.path.join(datadir, 'stats.txt')
@@ -80,8 +102,6 @@ class Stats:
                     record = line.strip().split(',')
                     try:
                         t = datetime.strptime(record[0], '%Y-%m-%d %H:%M:%S')
-                        if MAX_STATS_DAYS <= (datetime.today() - t).days:
-                            continue
                         ms = record[2].split(':')
                         if len(ms) != 2:
                             continue
@@ -90,6 +110,9 @@ class Stats:
                         touch_count = int(record[4])
                         if touch_count < correct_count:
                             touch_count = correct_count
+                        self._update_best(record[1].strip('"'), duration, correct_count, touch_count)
+                        if MAX_STATS_DAYS <= (datetime.today() - t).days:
+                            continue
                         key = t.strftime('%Y-%m-%d')
                         if key not in stats:
                             stats[key] = (duration, correct_count, touch_count)
@@ -122,6 +145,7 @@ class Stats:
         self.today_correct_count = 0
         self.today_touch_count = 0
         self.stats = list()
+        self.best = dict()  # the best score by lesson name
 
     def _update(self, date, duration, correct_count, touch_count):
         wpm = int(correct_count * 60 / duration / 5)
@@ -132,14 +156,23 @@ class Stats:
         if self.max_wpm < wpm:
             self.max_wpm = wpm
 
+    def _update_best(self, filename, duration, correct_count, touch_count):
+        if duration <= 0 or touch_count <= 0:
+            return
+        wpm = int(correct_count * 60 / duration / 5)
+        score = get_score(wpm, correct_count / touch_count)
+        if self.best.get(filename, -1) < score:
+            self.best[filename] = score
+
     def append(self, engine):
         t = datetime.now()
         duration = engine.get_duration()
         touch_count = engine.get_touch_count()
         correct_count = engine.get_correct_count()
+        name = engine.get_lesson_name(engine.get_filename())
         line = '{},"{}",{:02d}:{:04.1f},{:d},{:d}\n'.format(
             t.strftime('%Y-%m-%d %H:%M:%S'),
-            engine.get_filename(),
+            name,
             int(duration / 60), duration % 60,
             correct_count,
             touch_count)
@@ -149,6 +182,7 @@ class Stats:
         today = t.date()
         if touch_count < correct_count:
             touch_count = correct_count
+        self._update_best(name, duration, correct_count, touch_count)
         if not self.stats or self.stats[-1][0] != today:
             self.today_duration = duration
             self.today_touch_count = touch_count
@@ -164,6 +198,11 @@ class Stats:
         logger.info("Stats closed")
         self.file.close()
 
+    # Return the best score of the lesson, or None if it has not been
+    # practiced.
+    def get_best_score(self, filename):
+        return self.best.get(filename)
+
     def get_max_duration(self):
         return self.max_duration
 
@@ -178,11 +217,63 @@ class Stats:
         self.file = open(self.filename, mode='w')
 
 
+# Profiles keeps the Stats of the recently used profiles so that students
+# sharing a computer can switch between them without restarting the app.
+# The default profile '' uses the user data directory itself.
+class Profiles:
+    def __init__(self):
+        self.cache = OrderedDict()
+
+    def close(self):
+        for stats in self.cache.values():
+            stats.close()
+        self.cache.clear()
+
+    def get_datadir(self, name):
+        datadir = package.get_user_datadir()
+        if name:
+            datadir = os.path.join(datadir, 'profiles', name)
+        return datadir
+
+    # Return the Stats of the profile if they have been loaded, or None.
+    def get_loaded_stats(self, name):
+        return self.cache.get(name)
+
+    def get_names(self):
+        try:
+            names = os.listdir(os.path.join(package.get_user_datadir(), 'profiles'))
+        except OSError:
+            return list()
+        return sorted(name for name in names if self.is_valid(name))
+
+    def get_stats(self, name):
+        stats = self.cache.get(name)
+        if stats:
+            self.cache.move_to_end(name)
+            return stats
+        stats = Stats(self.get_datadir(name))
+        self.cache[name] = stats
+        while MAX_PROFILES < len(self.cache):
+            _, evicted = self.cache.popitem(last=False)
+            evicted.close()
+        return stats
+
+    def is_valid(self, name):
+        return not name.startswith('.') and os.sep not in name
+
+
 class Engine:
-    def __init__(self, roomazi):
+    def __init__(self, roomazi, on_loaded=None):
         self.roomazi = roomazi
+        self.on_loaded = on_loaded  # called when a lesson file has been loaded
+        self.loading = None         # (filename, path, mode, cancellable)
         self.ime_mode = 'A'
         self.dirname = ''
+        self.lessons = dict()   # (etag, lines) of the lesson files by path
+        self.preloading = Gio.Cancellable()
+        self.lessons_dir = os.path.join(package.get_datadir(), 'lessons')
+        self.bundle = open_bundle(os.path.join(self.lessons_dir, BUNDLE_NAME))
+        self.catalog = LessonCatalog(self.bundle)
         self.filename = ''
         self.lines = list()
         self.lineno = 0
@@ -191,6 +282,7 @@ class Engine:
         self.reading = ''
         self.plain = ''
         self.hint = ''
+        self.counts = None  # the key counts of the text in the bundle, if any
         self.correct_count = 0
         self.repeat = 0
         self.ramdom_list = list()
@@ -199,9 +291,10 @@ class Engine:
         self.reset_practice()
         self.menu = list()
         self.up_list = list()
-        self.min_accuracy = 0.85
-        self.min_WPM = 5
-        self.stats = Stats()
+        self.min_accuracy = MIN_ACCURACY
+        self.min_WPM = MIN_WPM
+        self.profiles = Profiles()
+        self.profile = ''
         self.ignore = [Gdk.KEY_BackSpace, Gdk.KEY_Caps_Lock,
                        Gdk.KEY_Henkan, Gdk.KEY_Hiragana_Katakana,
                        Gdk.KEY_Shift_L, Gdk.KEY_Shift_R]
@@ -209,6 +302,139 @@ class Engine:
     def __del__(self):
         self.quit()
 
+    # Follow the keystrokes with a RoomaziMatcher to count the misses exactly
+    # while kana are practiced with a roomazi layout.
+    def _feed_matcher(self, event, keyboard):
+        if self.matcher is None:
+            self.matcher = False
+            if (self.is_empty() and self.get_ime_mode() == 'あ' and keyboard.is_roomazi() and
+                    self.plain == self.reading):
+                self.matcher = self.roomazi.create_matcher(self.reading)
+        if not self.matcher:
+            return
+        if event.keyval == Gdk.KEY_Return:
+            key = '\n'
+        else:
+            c = Gdk.keyval_to_unicode(event.keyval)
+            if not c:
+                # Shift, the arrows and the function keys type no character.
+                return
+            # The IME takes the shifted Latin letters for the roomazi as well.
+            key = chr(c).lower()
+        self.matcher.feed(key)
+
+    # Return the etag of the file at path, or None if it is not available.
+    def _get_etag(self, path):
+        try:
+            info = Gio.File.new_for_path(path).query_info(Gio.FILE_ATTRIBUTE_ETAG_VALUE,
+                                                          Gio.FileQueryInfoFlags.NONE, None)
+        except GLib.Error:
+            return None
+        return info.get_etag()
+
+    def _get_path(self, filename):
+        if os.path.dirname(filename):
+            return filename
+        return os.path.join(self.dirname, filename)
+
+    def _on_lesson_loaded(self, file, result, request):
+        path, cancellable, callback, data = request
+        try:
+            ok, contents, etag = file.load_contents_finish(result)
+            lines = split_lines(contents)
+        except GLib.Error as e:
+            if not cancellable.is_cancelled():
+                logger.error('"%s" was not found: %s', path, e)
+            callback(None, data)
+            return
+        except UnicodeDecodeError as e:
+            logger.error('"%s" is not a UTF-8 text file: %s', path, e)
+            callback(None, data)
+            return
+        self.lessons[path] = (etag, lines)
+        self.catalog.update(path, etag, lines)
+        callback(lines, data)
+
+    def _on_lesson_opened(self, lines, loading):
+        if self.loading is not loading:
+            return
+        self.loading = None
+        filename, path, mode, cancellable = loading
+        if lines is None:
+            self.mode = mode
+        else:
+            self._set_lesson(filename, lines)
+        if self.on_loaded:
+            self.on_loaded()
+
+    def _on_lesson_preloaded(self, lines, keyboard):
+        if lines is None:
+            return
+        for text in get_texts(lines):
+            if not (self.bundle and self.bundle.get_text(text)):
+                plain, reading = get_plain_text(text)
+                keyboard.get_key_count(reading)
+
+    def _on_lesson_queried(self, file, result, request):
+        path, cancellable, callback, data = request
+        try:
+            etag = file.query_info_finish(result).get_etag()
+        except GLib.Error as e:
+            if not cancellable.is_cancelled():
+                logger.error('"%s" was not found: %s', path, e)
+            callback(None, data)
+            return
+        lesson = self.lessons.get(path)
+        if lesson and lesson[0] == etag:
+            callback(lesson[1], data)
+        else:
+            file.load_contents_async(cancellable, self._on_lesson_loaded, request)
+
+    # Read the lesson at path from the bundle, or from the file if the
+    # lesson is not bundled, and call callback(lines, data) with its lines,
+    # or with None if it cannot be read. A bundled lesson is read at once.
+    # A lesson file is read asynchronously, and read again only if its etag
+    # has changed since it was read last.
+    def _read_lesson(self, path, cancellable, callback, data=None):
+        lines = self.bundle.get_lines(path) if self.bundle else None
+        if lines is not None:
+            callback(lines, data)
+            return
+        file = Gio.File.new_for_path(path)
+        request = (path, cancellable, callback, data)
+        if path in self.lessons:
+            file.query_info_async(Gio.FILE_ATTRIBUTE_ETAG_VALUE, Gio.FileQueryInfoFlags.NONE,
+                                  GLib.PRIORITY_DEFAULT, cancellable, self._on_lesson_queried, request)
+        else:
+            file.load_contents_async(cancellable, self._on_lesson_loaded, request)
+
+    # Count the keys of the text when the practice starts, so that the
+    # keyboard layout is not loaded just to show a menu.
+    def _count_keys(self, keyboard):
+        self.correct_count = keyboard.get_key_count(self.reading, self.counts)
+
+    def _set_lesson(self, filename, lines):
+        self.lines = lines
+        self.lineno = 0
+        self.show_keyboard = False
+        self.text = ''
+        self.hint = ''
+        self.zenkaku = False
+        self.reset_practice()
+        self.mode = EngineMode.RUN
+        self.filename = filename
+        self.ime_mode = 'A'
+
+    def _set_text(self, text):
+        self.text = text
+        self.counts = None
+        self.correct_count = 0
+        info = self.bundle.get_text(text) if self.bundle else None
+        if info:
+            self.plain, self.reading, self.counts = info
+        else:
+            self.plain, self.reading = get_plain_text(text)
+
     def append(self, str):
         if self.is_practice_mode():
             was_empty = self.is_empty()
@@ -258,7 +484,7 @@ class Engine:
             self.up()
 
     def finish_practice(self, keyboard):
-        self.stats.append(self)
+        self.get_stats().append(self)
         if self.repeat == 0:
             self.mode = EngineMode.RUN
             return True
@@ -269,6 +495,14 @@ class Engine:
     def get_accuracy(self):
         return 1 - self.get_error_ratio()
 
+    # Return the best score of the lesson, or None if it has not been
+    # practiced or the stats of the profile have not been loaded yet.
+    def get_best_score(self, filename):
+        stats = self.profiles.get_loaded_stats(self.profile)
+        if not stats:
+            return None
+        return stats.get_best_score(self.get_lesson_name(filename))
+
     def get_correct_count(self):
         return self.correct_count
 
@@ -280,6 +514,8 @@ class Engine:
         return count * 60 / self.get_duration()
 
     def get_error_count(self):
+        if self.matcher and self.matcher.is_done():
+            return self.matcher.get_miss_count()
         missed = self.get_touch_count() - self.get_correct_count()
         if missed < 0:
             return 0
@@ -309,6 +545,45 @@ class Engine:
     def get_ime_mode(self):
         return self.ime_mode
 
+    # Return the LessonInfo of the lesson, or None if it is not known yet.
+    def get_lesson_info(self, filename):
+        return self.catalog.get(self._get_path(filename))
+
+    # Return the name of the lesson file to record in the stats, i.e., its
+    # path relative to the lessons directory as in the lesson bundle, or its
+    # absolute path if it is not in the lessons directory.
+    def get_lesson_name(self, filename):
+        path = self._get_path(filename)
+        return get_bundle_name(path, self.lessons_dir) or os.path.abspath(path)
+
+    def get_menu(self):
+        if self.mode != EngineMode.MENU and not (self.loading and self.loading[2] == EngineMode.MENU):
+            return []
+        return self.menu
+
+    # Return the lessons in the menu.
+    def get_menu_lessons(self):
+        if self.mode != EngineMode.MENU:
+            return []
+        return [name for name in self.menu if name not in ('stats', 'up', 'quit')]
+
+    # Return the lessons in the menu, followed by the lessons in their menus
+    # as told by the lesson catalog, since the entries in the top menu are
+    # mostly menus themselves.
+    def get_menu_lessons_to_preload(self):
+        lessons = self.get_menu_lessons()
+        for name in list(lessons):
+            info = self.get_lesson_info(name)
+            if not info:
+                continue
+            for entry in info.menu:
+                if entry in ('stats', 'up', 'quit'):
+                    continue
+                entry = os.path.join(os.path.dirname(name), entry)
+                if entry not in lessons:
+                    lessons.append(entry)
+        return lessons
+
     def get_mode(self):
         return self.mode
 
@@ -318,26 +593,21 @@ class Engine:
     def get_preedit(self):
         return self.preedit
 
-    """
-    3rd: 15 wpm, 85% accuracy
-    5th: 30 wpm
-    """
+    def get_profile(self):
+        return self.profile
+
+    def get_profiles(self):
+        return self.profiles
+
     def get_score(self):
-        wpm = self.get_wpm()
-        accuracy = self.min_accuracy + self.get_accuracy()
-        if 1 < accuracy:
-            accuracy = 1
-        wpm *= accuracy
-        score = int(wpm / self.min_WPM)
-        if 10 < score:
-            score = 10
-        return score
+        return get_score(self.get_wpm(), self.get_accuracy(), self.min_accuracy, self.min_WPM)
 
     def get_show_keyboard(self):
         return self.show_keyboard
 
+    # The stats of the profile are loaded when they are used first.
     def get_stats(self):
-        return self.stats
+        return self.profiles.get_stats(self.profile)
 
     def get_text(self):
         return self.text
@@ -371,6 +641,9 @@ class Engine:
     def is_practice_mode(self):
         return self.mode == EngineMode.PRACTICE
 
+    def is_started(self):
+        return 0 < self.start_time
+
     def is_timeup(self):
         return TIME_OVER <= self.get_duration()
 
@@ -381,35 +654,46 @@ class Engine:
             return
         if self.get_ime_mode() != 'A' and keyboard.is_ignore(event):
             return
+        if event.keyval == Gdk.KEY_BackSpace:
+            # The matcher cannot follow the corrections made in the IME.
+            self.matcher = False
         if event.keyval not in self.ignore:
             self.touch_count += 1
+            self._feed_matcher(event, keyboard)
 
     def markup(self, s: str):
         s = s.replace('<kbd>', '<span background="#00cc99" foreground="#FFFFFF">')
         s = s.replace('</kbd>', '</span>')
         return s
 
+    # A bundled lesson, or a lesson file whose etag has not changed since it
+    # was read last, is opened at once. Otherwise the lesson file is loaded
+    # asynchronously in the LOADING mode not to block drawing on a slow file
+    # system, and the lesson starts when on_loaded is called. The window keeps
+    # showing the last screen meanwhile.
     def open(self, filename):
-        try:
-            dirname = os.path.dirname(filename)
-            if not dirname:
-                path = self.dirname + '/' + filename
-            else:
-                self.dirname = dirname
-                path = filename
-            with open(path, 'r') as file:
-                self.lineno = 0
-                self.lines = file.readlines()
-                self.show_keyboard = False
-                self.text = ''
-                self.hint = ''
-                self.zenkaku = False
-                self.reset_practice()
-                self.mode = EngineMode.RUN
-                self.filename = filename
-                self.ime_mode = 'A'
-        except:
-            logger.error('"%s" was not found.', filename)
+        dirname = os.path.dirname(filename)
+        if not dirname:
+            path = os.path.join(self.dirname, filename)
+        else:
+            self.dirname = dirname
+            path = filename
+        mode = self.mode
+        if self.loading:
+            mode = self.loading[2]
+            self.loading[3].cancel()
+            self.loading = None
+        lines = self.bundle.get_lines(path) if self.bundle else None
+        if lines is None:
+            lesson = self.lessons.get(path)
+            if lesson and lesson[0] == self._get_etag(path):
+                lines = lesson[1]
+        if lines is not None:
+            self._set_lesson(filename, lines)
+            return
+        self.loading = (filename, path, mode, Gio.Cancellable())
+        self.mode = EngineMode.LOADING
+        self._read_lesson(path, self.loading[3], self._on_lesson_opened, self.loading)
 
     def pick_text(self, keyboard):
         self.text = ''
@@ -420,14 +704,22 @@ class Engine:
             else:
                 self.text += ' '
             self.repeat -= 1
-        self.text = self.text.strip()
-        self.plain, self.reading = get_plain_text(self.text)
-        self.correct_count = keyboard.get_key_count(self.reading)
+        self._set_text(self.text.strip())
+        self._count_keys(keyboard)
         self.repeat = 0
 
+    # Read the lesson file in advance, and count the keys of its texts so
+    # that the counts are memoized before the lesson is started.
+    def preload(self, filename, keyboard):
+        self._read_lesson(self._get_path(filename), self.preloading, self._on_lesson_preloaded, keyboard)
+
     def quit(self):
+        if self.loading:
+            self.loading[3].cancel()
+            self.loading = None
+        self.preloading.cancel()
         if self.mode != EngineMode.EXIT:
-            self.stats.close()
+            self.profiles.close()
         self.mode = EngineMode.EXIT
 
     def reset_practice(self):
@@ -435,9 +727,10 @@ class Engine:
         self.preedit = ('', None, 0)
         self.start_time = self.finish_time = 0
         self.touch_count = 0
+        self.matcher = None
 
     def run(self, keyboard):
-        if not self.lines:
+        if not self.lines or self.mode == EngineMode.LOADING:
             return False
         if self.mode == EngineMode.PRACTICE:
             if self.is_timeup():
@@ -462,9 +755,7 @@ class Engine:
                     continue
                 text = text.rstrip()
                 if self.mode == EngineMode.TEXT:
-                    self.text = text
-                    self.plain, self.reading = get_plain_text(text)
-                    self.correct_count = keyboard.get_key_count(self.reading)
+                    self._set_text(text)
                 else:
                     self.hint = text
                 text = ''
@@ -495,6 +786,7 @@ class Engine:
                 self.mode = EngineMode.PRACTICE
                 return True
             elif line.startswith(":start"):
+                self._count_keys(keyboard)
                 self.reset_practice()
                 self.mode = EngineMode.PRACTICE
                 return True
@@ -554,6 +846,17 @@ class Engine:
                 if was_empty:
                     self.start_test()
 
+    def set_profile(self, name):
+        name = name.strip()
+        if not self.profiles.is_valid(name):
+            logger.error('"%s" is not a valid profile name.', name)
+            return False
+        self.profile = name
+        if self.is_practice_mode():
+            self.reset_practice()
+        logger.info("profile: %s", name)
+        return True
+
     def show_stats(self):
         assert self.mode == EngineMode.MENU
         self.mode = EngineMode.STATS
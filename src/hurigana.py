@@ -14,7 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from lesson import BASE, IAA, IAS, IAT, PLAIN, RUBY
+
+import bisect
 import cairo
+from collections import OrderedDict
 import logging
 import gi
 gi.require_version('Gtk', '3.0')
@@ -26,38 +30,16 @@ import re
 
 logger = logging.getLogger(__name__)
 
-IAA = '\uFFF9'  # IAA (INTERLINEAR ANNOTATION ANCHOR)
-IAS = '\uFFFA'  # IAS (INTERLINEAR ANNOTATION SEPARATOR)
-IAT = '\uFFFB'  # IAT (INTERLINEAR ANNOTATION TERMINATOR)
-
-PLAIN = 0
-BASE = 1
-RUBY = 2
-
-HIRAGANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをんゔがぎぐげござじずぜぞだぢづでどばびぶべぼぁぃぅぇぉゃゅょっぱぴぷぺぽゎゐゑ・ーゝゞ"
-KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワヲンヴガギグゲゴザジズゼゾダヂヅデドバビブベボァィゥェォャュョッパピプペポヮヰヱ・ーヽヾ"
-TO_HIRAGANA = str.maketrans(KATAKANA, HIRAGANA)
+MAX_LAYOUTS = 16
 
 
-def get_plain_text(text: str):
-    plain = ''
-    reading = ''
-    mode = PLAIN
+def get_offsets(text: str):
+    offsets = [0]
+    offset = 0
     for c in text:
-        if c == IAA:
-            mode = BASE
-        elif c == IAS:
-            mode = RUBY
-        elif c == IAT:
-            mode = PLAIN
-        elif mode == BASE:
-            plain += c
-        elif mode == RUBY:
-            reading += c
-        else:
-            plain += c
-            reading += c
-    return plain, reading.translate(TO_HIRAGANA)
+        offset += len(c.encode())
+        offsets.append(offset)
+    return offsets
 
 
 class HuriganaLayout:
@@ -67,87 +49,104 @@ class HuriganaLayout:
         self.text = ''      # including rubies
         self.markup = ''    # including tags
         self.plain = ''
+        self.offsets = [0]  # UTF-8 offsets of the characters in self.plain
         self.rubies = list()
         self.ruby_size = 8
+        self.runs = None
+        self.ruby_layouts = dict()
+        self.line_starts = None
 
     def _draw_rubies(self, offset_x, offset_y):
-        lt = PangoCairo.create_layout(self.ctx)
+        if self.runs is None:
+            self._layout_rubies()
+        for lt in self.ruby_layouts.values():
+            PangoCairo.update_layout(self.ctx, lt[0])
+        for x, y, lt in self.runs:
+            self.ctx.move_to(offset_x + x, offset_y + y)
+            PangoCairo.show_layout(self.ctx, lt)
+
+    def _get_ruby_layout(self, desc, text, tag):
+        if tag:
+            text = tag + text + '</span>'
+        lt = self.ruby_layouts.get(text)
+        if not lt:
+            layout = PangoCairo.create_layout(self.ctx)
+            layout.set_font_description(desc)
+            layout.set_markup(text, -1)
+            PangoCairo.update_layout(self.ctx, layout)
+            w, h = layout.get_pixel_size()
+            lt = (layout, w, h)
+            self.ruby_layouts[text] = lt
+        return lt
+
+    # Return the character offsets at which each line starts.
+    def _get_line_starts(self):
+        if self.line_starts is None:
+            PangoCairo.update_layout(self.ctx, self.layout)
+            self.line_starts = list()
+            iter = self.layout.get_iter()
+            while True:
+                self.line_starts.append(bisect.bisect_left(self.offsets, iter.get_index()))
+                if not iter.next_line():
+                    break
+        return self.line_starts
+
+    def _invalidate(self):
+        self.runs = None
+        self.ruby_layouts.clear()
+        self.line_starts = None
+
+    # Compute where each ruby is drawn. Rubies over a line break are split
+    # into two runs.
+    def _layout_rubies(self):
+        self.runs = list()
+        if not self.rubies:
+            return
         desc = self.font_description.copy_static()
         desc.set_size(self.ruby_size * Pango.SCALE)
-        lt.set_font_description(desc)
         for pos, length, ruby, tag in self.rubies:
-            text = self.plain[:pos]
-            left = self.layout.index_to_pos(len(text.encode()))
-            text = self.plain[:pos + length - 1]
-            right = self.layout.index_to_pos(len(text.encode()))
+            left = self.layout.index_to_pos(self.offsets[pos])
+            right = self.layout.index_to_pos(self.offsets[max(pos, pos + length - 1)])
             left.x /= Pango.SCALE
             left.y /= Pango.SCALE
             right.x += right.width
             right.x /= Pango.SCALE
             right.y /= Pango.SCALE
             if left.y == right.y:
-                self.ctx.save()
-                if tag:
-                    ruby = tag + ruby + '</span>'
-                lt.set_markup(ruby, -1)
-                PangoCairo.update_layout(self.ctx, lt)
-                w, h = lt.get_pixel_size()
+                lt, w, h = self._get_ruby_layout(desc, ruby, tag)
                 x = (left.x + right.x - w) / 2
                 if x < 0:
                     x = 0
                 elif self.width < x + w:
                     x = self.width - w
                 y = left.y - h * 3 / 4
-                self.ctx.move_to(offset_x + x, offset_y + y)
-                PangoCairo.show_layout(self.ctx, lt)
-                self.ctx.restore()
+                self.runs.append((x, y, lt))
             else:
                 ruby_width = (self.width - left.x) + right.x
                 left_length = round(len(ruby) * (self.width - left.x) / ruby_width)
                 if 0 < left_length:
-                    text = ruby[:left_length]
-                    self.ctx.save()
-                    if tag:
-                        text = tag + text + '</span>'
-                    lt.set_markup(text, -1)
-                    PangoCairo.update_layout(self.ctx, lt)
-                    w, h = lt.get_pixel_size()
-                    x = self.width - w
-                    y = left.y - h * 3 / 4
-                    self.ctx.move_to(offset_x + x, offset_y + y)
-                    PangoCairo.show_layout(self.ctx, lt)
-                    self.ctx.restore()
+                    lt, w, h = self._get_ruby_layout(desc, ruby[:left_length], tag)
+                    self.runs.append((self.width - w, left.y - h * 3 / 4, lt))
                 if left_length < len(ruby):
-                    text = ruby[left_length:]
-                    self.ctx.save()
-                    if tag:
-                        text = tag + text + '</span>'
-                    lt.set_markup(text, -1)
-                    PangoCairo.update_layout(self.ctx, lt)
-                    w, h = lt.get_pixel_size()
-                    x = 0
-                    y = right.y - h * 3 / 4
-                    self.ctx.move_to(offset_x + x, offset_y + y)
-                    PangoCairo.show_layout(self.ctx, lt)
-                    self.ctx.restore()
+                    lt, w, h = self._get_ruby_layout(desc, ruby[left_length:], tag)
+                    self.runs.append((0, right.y - h * 3 / 4, lt))
 
+    # Insert a newline into typed wherever the practice text is wrapped so
+    # that typed is laid out just like the practice text.
     def adjust_typed(self, typed):
-        current = 0
-        length = len(typed)
-        if length < len(self.plain):
-            length += 1
-        adjusted = ''
-        for i in range(length):
-            index = len(self.plain[:i].encode())
-            (line, x) = self.layout.index_to_line_x(index, False)
-            if line != current and adjusted[-1] != '\n':
-                adjusted += '\n' + self.plain[i]
-            else:
-                adjusted += self.plain[i]
-            current = line
         if len(typed) < len(self.plain):
-            adjusted = adjusted[:-1]
-        return adjusted
+            end = len(typed) + 1
+        else:
+            end = len(typed)
+        starts = self._get_line_starts()
+        lines = list()
+        last = 0
+        for start in starts[1:bisect.bisect_left(starts, end)]:
+            if self.plain[start - 1] != '\n':
+                lines.append(typed[last:start])
+                last = start
+        lines.append(typed[last:])
+        return '\n'.join(lines)
 
     def draw(self, x, y):
         self.ctx.move_to(x, y)
@@ -155,9 +154,20 @@ class HuriganaLayout:
         PangoCairo.show_layout(self.ctx, self.layout)
         self._draw_rubies(x, y)
 
+    # Return the position of the character at pos in the plain text as
+    # (x, y, width, height) in pixels.
+    def get_char_pos(self, pos):
+        PangoCairo.update_layout(self.ctx, self.layout)
+        rect = self.layout.index_to_pos(self.offsets[pos])
+        return rect.x / Pango.SCALE, rect.y / Pango.SCALE, rect.width / Pango.SCALE, rect.height / Pango.SCALE
+
+    def set_context(self, ctx: cairo.Context):
+        self.ctx = ctx
+
     def set_font_description(self, desc):
         self.font_description = desc
         self.layout.set_font_description(desc)
+        self._invalidate()
 
     def set_markup(self, text):
         self.text = text
@@ -202,13 +212,17 @@ class HuriganaLayout:
                 else:
                     self.plain += c
                     i += 1
+        self.offsets = get_offsets(self.plain)
         self.layout.set_markup(self.markup, -1)
+        self._invalidate()
 
     def set_ruby_size(self, size):
         self.ruby_size = size
+        self._invalidate()
 
     def set_spacing(self, spacing):
         self.layout.set_spacing(spacing * Pango.SCALE)
+        self._invalidate()
 
     def set_text(self, text):
         self.text = text
@@ -234,8 +248,48 @@ class HuriganaLayout:
             else:
                 self.plain += c
                 i += 1
+        self.offsets = get_offsets(self.plain)
         self.layout.set_text(self.plain, -1)
+        self._invalidate()
 
     def set_width(self, width):
         self.width = width
         self.layout.set_width(self.width * Pango.SCALE)
+        self._invalidate()
+
+
+# HuriganaCache keeps the recently drawn HuriganaLayouts so that the text is
+# parsed and shaped only once; each frame just updates the cairo context.
+class HuriganaCache:
+    def __init__(self, size=MAX_LAYOUTS):
+        self.size = size
+        self.layouts = OrderedDict()
+        self.fonts = dict()
+
+    def clear(self):
+        self.layouts.clear()
+
+    def get(self, ctx: cairo.Context, text, font, width, spacing, ruby_size=8, markup=False):
+        key = (text, markup, font, width, spacing, ruby_size)
+        hurigana = self.layouts.get(key)
+        if hurigana:
+            self.layouts.move_to_end(key)
+            hurigana.set_context(ctx)
+            return hurigana
+        desc = self.fonts.get(font)
+        if not desc:
+            desc = Pango.font_description_from_string(font)
+            self.fonts[font] = desc
+        hurigana = HuriganaLayout(ctx)
+        hurigana.set_ruby_size(ruby_size)
+        hurigana.set_font_description(desc)
+        hurigana.set_width(width)
+        hurigana.set_spacing(spacing)
+        if markup:
+            hurigana.set_markup(text)
+        else:
+            hurigana.set_text(text)
+        self.layouts[key] = hurigana
+        if self.size < len(self.layouts):
+            self.layouts.popitem(last=False)
+        return hurigana
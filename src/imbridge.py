@@ -0,0 +1,64 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from gi.repository import Gdk
+
+logger = logging.getLogger(__name__)
+
+
+# IMBridge passes the caret and the surrounding text to the input method.
+# Since each update can be a round trip to the input method, the cursor
+# location is sent only when it moves, and the byte offset of the end of
+# the surrounding text is kept for the next query.
+class IMBridge:
+
+    def __init__(self, im_context):
+        self.im_context = im_context
+        self.location = None    # (x, y, width, height) sent last
+        self.text = ''
+        self.length = 0         # the length of self.text in bytes
+
+    def _get_length(self, text):
+        if text != self.text:
+            if text.startswith(self.text):
+                self.length += len(text[len(self.text):].encode())
+            else:
+                self.length = len(text.encode())
+            self.text = text
+        return self.length
+
+    def focus_in(self):
+        # The input method may have lost the cursor location meanwhile.
+        self.location = None
+        self.im_context.focus_in()
+
+    def focus_out(self):
+        self.im_context.focus_out()
+
+    def set_cursor_location(self, x, y, width, height):
+        location = (int(x), int(y), int(width), int(height))
+        if location == self.location:
+            return
+        self.location = location
+        rect = Gdk.Rectangle()
+        rect.x, rect.y, rect.width, rect.height = location
+        self.im_context.set_cursor_location(rect)
+
+    def set_surrounding(self, text):
+        length = self._get_length(text)
+        self.im_context.set_surrounding(text, length, length)
@@ -15,47 +15,246 @@
 # limitations under the License.
 
 import logging
+import os
 
 from gi import require_version
-require_version('IBus', '1.0')
-from gi.repository import Gio, IBus
+require_version('Gtk', '3.0')
+from gi.repository import Gio, Gtk
 
 
 HIRAGANA_IME_KEY = 'org.freedesktop.ibus.engine.hiragana'
+TIMEOUT = 5000      # msec
 
 logger = logging.getLogger(__name__)
-default_engine = ''
+
+# The IME backend is 'ibus' or 'simulator'. It can be selected with the
+# TYPING_PRACTICE_IME environment variable or with set_backend() before
+# the first window is created.
+backend = None
+backend_name = os.environ.get('TYPING_PRACTICE_IME', 'ibus')
+script = os.environ.get('TYPING_PRACTICE_IME_SCRIPT', '')
 
 
 def check_engine():
-    global default_engine
+    get_backend().check_engine()
+
+
+def create_context(widget):
+    return get_backend().create_context(widget)
+
+
+# Import IBus when it is used first. The typelib may not be installed.
+def _import_ibus():
     try:
-        bus = IBus.Bus()
-        engine = bus.get_global_engine()
-        default_engine = engine.get_name()
-        logger.info("check_engine %s", default_engine)
-        if default_engine == 'hiragana':
-            return
-        bus.set_global_engine('hiragana')
-    except Exception as e:
+        require_version('IBus', '1.0')
+        from gi.repository import IBus
+    except (ImportError, ValueError) as e:
         logger.error(str(e))
+        return None
+    return IBus
+
+
+def get_backend():
+    global backend
+    if backend is None:
+        if backend_name == 'simulator':
+            from imsim import SimulatorBackend
+            backend = SimulatorBackend(script)
+        else:
+            if backend_name != 'ibus':
+                logger.error("unknown IME backend: %s", backend_name)
+            backend = IBusBackend()
+    return backend
 
 
 def restore_engine():
-    global default_engine
-    if default_engine == 'hiragana':
-        return
-    try:
-        logger.info("restore_engine %s", default_engine)
-        bus = IBus.Bus()
-        bus.set_global_engine(default_engine)
-    except Exception as e:
-        logger.error(str(e))
+    get_backend().restore_engine()
+
+
+def set_backend(name, script_path=''):
+    global backend_name, script
+    backend_name = name
+    if script_path:
+        script = script_path
 
 
 def set_mode(mode):
-    source = Gio.SettingsSchemaSource.get_default()
-    if source.lookup(HIRAGANA_IME_KEY, True):
-        config = Gio.Settings.new(HIRAGANA_IME_KEY)
+    get_backend().set_mode(mode)
+
+
+# IBusBackend switches the global IBus engine to ibus-hiragana while the
+# window has the focus. The engine switches are made asynchronously over
+# one IBus connection. While a call is in flight, focus changes only update
+# self.active, and the engine for the last focus state is applied when the
+# call completes.
+class IBusBackend:
+    def __init__(self):
+        self.bus = None
+        self.busy = False
+        self.active = False         # True while the window has the focus
+        self.applied = ''           # the global engine as far as we know
+        self.default_engine = ''    # the global engine before switching to hiragana
+        self.mode_controller = ModeController()
+
+    def _apply(self):
+        if self.busy:
+            return
+        bus = self._get_bus()
+        if not bus:
+            return
+        if self.active:
+            if self.applied != 'hiragana':
+                self.busy = True
+                bus.get_global_engine_async(TIMEOUT, None, self._on_get_global_engine, 'hiragana')
+            elif not self.mode_controller.is_synced():
+                self.mode_controller.refresh()
+        elif self.applied == 'hiragana' and self.default_engine not in ('', 'hiragana'):
+            logger.info("restore_engine %s", self.default_engine)
+            self.busy = True
+            bus.set_global_engine_async(self.default_engine, TIMEOUT, None,
+                                        self._on_set_global_engine, self.default_engine)
+
+    def _get_bus(self):
+        if self.bus is None:
+            IBus = _import_ibus()
+            if IBus is None:
+                return None
+            self.bus = IBus.Bus()
+            self.bus.connect('disconnected', self._on_disconnected)
+        if not self.bus.is_connected():
+            # Try a new connection next time.
+            self.bus = None
+            self.applied = ''
+            return None
+        return self.bus
+
+    # Return the engine to apply for the current focus state.
+    def _get_target(self):
+        return 'hiragana' if self.active else self.default_engine
+
+    def _on_disconnected(self, bus):
+        logger.info("disconnected from ibus")
+        if bus is self.bus:
+            self.bus = None
+            self.busy = False
+            self.applied = ''
+            self.mode_controller.invalidate()
+
+    def _on_get_global_engine(self, bus, result, target):
+        self.busy = False
+        try:
+            engine = bus.get_global_engine_async_finish(result)
+            self.applied = engine.get_name() if engine else ''
+        except Exception as e:
+            logger.error(str(e))
+            self._retarget(target)
+            return
+        if not self.active:
+            # The focus has left before switching the engine.
+            return
+        self.default_engine = self.applied
+        logger.info("check_engine %s", self.default_engine)
+        if self.applied != 'hiragana':
+            self.busy = True
+            bus.set_global_engine_async('hiragana', TIMEOUT, None, self._on_set_global_engine, 'hiragana')
+
+    def _on_set_global_engine(self, bus, result, name):
+        self.busy = False
+        try:
+            if bus.set_global_engine_async_finish(result):
+                self.applied = name
+        except Exception as e:
+            logger.error(str(e))
+            self._retarget(name)
+            return
+        if self.applied == 'hiragana':
+            # The engine has just been switched; _apply() tells it the mode.
+            self.mode_controller.invalidate()
+        self._apply()
+
+    # Apply the focus change made while the failed call for target was in
+    # flight, without retrying the failed call itself.
+    def _retarget(self, target):
+        if self._get_target() != target:
+            self._apply()
+
+    def check_engine(self):
+        self.active = True
+        # The mode may have been changed while the window was not focused.
+        self.mode_controller.check()
+        try:
+            self._apply()
+        except Exception as e:
+            logger.error(str(e))
+
+    def create_context(self, widget):
+        return Gtk.IMMulticontext()
+
+    def restore_engine(self):
+        self.active = False
+        try:
+            self._apply()
+        except Exception as e:
+            logger.error(str(e))
+
+    def set_mode(self, mode):
+        self.mode_controller.set_mode(mode)
+
+
+# ModeController sets the input mode of ibus-hiragana through its settings.
+# ibus-hiragana follows the changes of the 'mode' key, so the key is
+# written only when the mode differs from the stored one, or toggled when
+# the engine has to be told the mode it might not be in, i.e., after the
+# engine has been switched or reset.
+class ModeController:
+    def __init__(self):
+        self.config = None
+        self.mode = ''          # the mode requested last; '' if none
+        self.synced = False     # True while the engine is known to be in self.mode
+
+    def _get_config(self):
+        if self.config is None:
+            self.config = False
+            source = Gio.SettingsSchemaSource.get_default()
+            if source.lookup(HIRAGANA_IME_KEY, True):
+                self.config = Gio.Settings.new(HIRAGANA_IME_KEY)
+        return self.config
+
+    def _toggle(self, config, mode):
         config.set_string('mode', 'A' if mode != 'A' else 'あ')
         config.set_string('mode', mode)
+
+    # Check if the mode has been changed by someone else.
+    def check(self):
+        config = self._get_config()
+        if config and self.mode and config.get_string('mode') != self.mode:
+            self.synced = False
+
+    def invalidate(self):
+        self.synced = False
+
+    def is_synced(self):
+        return self.synced
+
+    # Apply the current mode again to the engine that has just been
+    # activated.
+    def refresh(self):
+        config = self._get_config()
+        if not config or not self.mode:
+            return
+        if config.get_string('mode') != self.mode:
+            config.set_string('mode', self.mode)
+        else:
+            self._toggle(config, self.mode)
+        self.synced = True
+
+    def set_mode(self, mode):
+        config = self._get_config()
+        if not config:
+            return
+        if config.get_string('mode') != mode:
+            config.set_string('mode', mode)
+        elif self.mode != mode or not self.synced:
+            self._toggle(config, mode)
+        self.mode = mode
+        self.synced = True
@@ -0,0 +1,256 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from roomazi import ALTERNATIVES, KANA_TO_ROOMAZI
+
+import logging
+import random
+import statistics
+import time
+
+from gi import require_version
+require_version('Gdk', '3.0')
+require_version('Pango', '1.0')
+from gi.repository import Gdk, GLib, GObject, Pango
+
+logger = logging.getLogger(__name__)
+
+START_DELAY = 1000      # msec before playing the script
+KEY_INTERVAL = 150      # mean interval between the keys in msec
+KEY_JITTER = 40         # standard deviation of the interval in msec
+MIN_KEY_INTERVAL = 20   # msec
+
+
+def get_roomazi_table():
+    table = dict()
+    for kana, roomazi in KANA_TO_ROOMAZI.items():
+        if kana[0] != 'ん' or len(kana) == 1:
+            table[roomazi] = kana
+    for kana, spellings in ALTERNATIVES.items():
+        for roomazi in spellings:
+            table.setdefault(roomazi, kana)
+    table['nn'] = table["n'"] = 'ん'
+    return table
+
+
+ROOMAZI_TO_KANA = get_roomazi_table()
+PREFIXES = frozenset(roomazi[:i] for roomazi in ROOMAZI_TO_KANA for i in range(1, len(roomazi)))
+
+
+# SimulatedContext stands in for Gtk.IMMulticontext without any input
+# method running. Like ibus-hiragana, it keeps the roomazi being typed in
+# the preedit and commits each kana as soon as it is complete. The other
+# characters, including kana from a kana layout, are committed as they are.
+class SimulatedContext(GObject.Object):
+    __gsignals__ = {
+        'commit': (GObject.SignalFlags.RUN_LAST, None, (str,)),
+        'delete-surrounding': (GObject.SignalFlags.RUN_LAST, bool, (int, int)),
+        'preedit-changed': (GObject.SignalFlags.RUN_LAST, None, ()),
+        'preedit-end': (GObject.SignalFlags.RUN_LAST, None, ()),
+        'preedit-start': (GObject.SignalFlags.RUN_LAST, None, ()),
+        'retrieve-surrounding': (GObject.SignalFlags.RUN_LAST, bool, ()),
+    }
+
+    def __init__(self, backend, widget):
+        super().__init__()
+        self.backend = backend
+        self.widget = widget
+        self.preedit = ''
+
+    def _convert(self):
+        committed = ''
+        while self.preedit:
+            kana = ROOMAZI_TO_KANA.get(self.preedit)
+            if kana and self.preedit not in PREFIXES:
+                committed += kana
+                self.preedit = ''
+            elif self.preedit in PREFIXES:
+                break
+            elif 2 <= len(self.preedit) and self.preedit[0] == self.preedit[1] and self.preedit[0] not in 'aiueon':
+                committed += 'っ'
+                self.preedit = self.preedit[1:]
+            elif self.preedit[0] == 'n':
+                committed += 'ん'
+                self.preedit = self.preedit[1:]
+            else:
+                committed += self.preedit[0]
+                self.preedit = self.preedit[1:]
+        return committed
+
+    def _flush(self):
+        if self.preedit:
+            committed = self.preedit
+            if committed == 'n':
+                committed = 'ん'
+            self._set_preedit('')
+            self.emit('commit', committed)
+
+    def _set_preedit(self, preedit):
+        if preedit == self.preedit:
+            return
+        started = not self.preedit
+        self.preedit = preedit
+        if started:
+            self.emit('preedit-start')
+        self.emit('preedit-changed')
+        if not preedit:
+            self.emit('preedit-end')
+
+    def filter_keypress(self, event):
+        if event.type != Gdk.EventType.KEY_PRESS:
+            return False
+        if event.state & (Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.MOD1_MASK):
+            return False
+        if event.keyval == Gdk.KEY_BackSpace and self.preedit:
+            self._set_preedit(self.preedit[:-1])
+            return True
+        c = chr(Gdk.keyval_to_unicode(event.keyval))
+        if not c.isprintable():
+            self._flush()
+            return False
+        if self.backend.mode == 'A' or not c.isascii():
+            self._flush()
+            self.emit('commit', c)
+            return True
+        if c == ' ':
+            self._flush()
+            self.emit('commit', '　')
+            return True
+        old = self.preedit
+        self.preedit += c.lower()
+        committed = self._convert()
+        preedit = self.preedit
+        self.preedit = old
+        if committed:
+            self._set_preedit('')
+            self.emit('commit', committed)
+        self._set_preedit(preedit)
+        return True
+
+    def focus_in(self):
+        self.backend.on_focus_in(self)
+
+    def focus_out(self):
+        self._flush()
+
+    def get_preedit_string(self):
+        return self.preedit, Pango.AttrList(), len(self.preedit)
+
+    def reset(self):
+        self._set_preedit('')
+
+    def set_client_window(self, window):
+        pass
+
+    def set_cursor_location(self, rect):
+        pass
+
+    def set_surrounding(self, text, length, cursor_index):
+        pass
+
+
+# SimulatorBackend replaces IBus and ibus-hiragana with SimulatedContext.
+# If a script file is given, its text is typed into the window as the key
+# events at human-like intervals once the window gets the focus, and the
+# throughput and the latencies are logged at the end:
+#
+#   dispatch: the time to handle a key event, including the commit
+#   paint: the time from a key event to the end of the next frame
+class SimulatorBackend:
+    def __init__(self, script=''):
+        self.mode = 'A'
+        self.keys = ''
+        if script:
+            try:
+                with open(script) as file:
+                    self.keys = file.read()
+            except OSError as e:
+                logger.error(str(e))
+        self.context = None
+        self.position = -1      # -1 until the script is started
+        self.start_time = 0
+        self.pending = list()   # key times waiting for the next frame
+        self.dispatch_times = list()
+        self.paint_times = list()
+        self.paint_id = 0
+
+    def _next_interval(self):
+        return max(MIN_KEY_INTERVAL, int(random.gauss(KEY_INTERVAL, KEY_JITTER)))
+
+    def _play(self):
+        widget = self.context.widget
+        if len(self.keys) <= self.position or not widget.get_window():
+            self._report()
+            return GLib.SOURCE_REMOVE
+        if not self.paint_id:
+            clock = widget.get_frame_clock()
+            if clock:
+                self.paint_id = clock.connect('after-paint', self.on_after_paint)
+        c = self.keys[self.position]
+        self.position += 1
+        if c == '\n':
+            keyval = Gdk.KEY_Return
+        else:
+            keyval = Gdk.unicode_to_keyval(ord(c))
+        now = time.monotonic()
+        for event_type in (Gdk.EventType.KEY_PRESS, Gdk.EventType.KEY_RELEASE):
+            event = Gdk.Event.new(event_type)
+            event.key.keyval = keyval
+            event.key.time = Gdk.CURRENT_TIME
+            event.set_device(widget.get_display().get_default_seat().get_keyboard())
+            widget.event(event)
+        self.dispatch_times.append(time.monotonic() - now)
+        self.pending.append(now)
+        GLib.timeout_add(self._next_interval(), self._play)
+        return GLib.SOURCE_REMOVE
+
+    def _report(self):
+        if not self.dispatch_times:
+            return
+        elapsed = time.monotonic() - self.start_time
+        count = len(self.dispatch_times)
+        logger.info("simulator: %d keys in %.1f s (%.1f keys/s)", count, elapsed, count / elapsed)
+        for name, times in (('dispatch', self.dispatch_times), ('paint', self.paint_times)):
+            if not times:
+                continue
+            times = sorted(t * 1000 for t in times)
+            logger.info("simulator: %s latency mean %.2f ms, median %.2f ms, 95%% %.2f ms, max %.2f ms",
+                        name, statistics.mean(times), statistics.median(times),
+                        times[int(0.95 * (len(times) - 1))], times[-1])
+
+    def check_engine(self):
+        pass
+
+    def create_context(self, widget):
+        self.context = SimulatedContext(self, widget)
+        return self.context
+
+    def on_after_paint(self, clock):
+        now = time.monotonic()
+        self.paint_times.extend(now - t for t in self.pending)
+        self.pending.clear()
+
+    def on_focus_in(self, context):
+        if self.keys and self.position < 0 and context is self.context:
+            self.position = 0
+            self.start_time = time.monotonic()
+            GLib.timeout_add(START_DELAY, self._play)
+
+    def restore_engine(self):
+        pass
+
+    def set_mode(self, mode):
+        self.mode = mode
@@ -14,14 +14,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from keymap import (DAKU, DAKU_TO_NON_DAKU, HANDAKU, HANDAKU_TO_NON_HANDAKU, KOGAKI, KOGAKI_TO_NON_KOGAKI,
+                    LAYOUT_104, LAYOUT_109, NO_SHIFT, SHIFT_LEFT, SHIFT_RIGHT, count_kana_keys, get_key_index)
 from roomazi import Roomazi
 
 import cairo
 import json
 import logging
 import math
+import os
 
 from gi import require_version
+require_version('Gdk', '3.0')
 from gi.repository import Gdk, Gio
 
 
@@ -42,51 +46,52 @@ LAYOUT_109 = ((100, 100, 100, 100, 100, 100, 100, 100, 100, 100, 100, 100, 100,
               (150, 125, 125, 150, 250, 150, 125, 100, 100, 100, 125))
 """
 
-DAKU = 'がぎぐげござじずぜぞだぢづでどばびぶべぼゔ'
-NON_DAKU = 'かきくけこさしすせそたちつてとはひふへほう'
-
-HANDAKU = 'ぱぴぷぺぽ'
-NON_HANDALU = 'はひふへほ'
-
-KOGAKI = 'ぁぃぅぇぉゃゅょっ'
-NON_KOGAKI = 'あいうえおやゆよつ'
-
-DAKU_TO_NON_DAKU = str.maketrans(DAKU, NON_DAKU)
-HANDAKU_TO_NON_HANDAKU = str.maketrans(HANDAKU, NON_HANDALU)
-KOGAKI_TO_NON_KOGAKI = str.maketrans(KOGAKI, NON_KOGAKI)
+KEY_COLORS = {
+    1: (0x00, 0x66, 0xff),
+    2: (0x99, 0xcc, 0x33),
+    3: (0xff, 0x99, 0x33),
+    4: (0xff, 0x33, 0x33),
+    5: (0xff, 0x33, 0x33),
+    6: (0xff, 0x33, 0x33),
+    7: (0xff, 0x33, 0x33),
+    8: (0xff, 0x99, 0x33),
+    9: (0x99, 0xcc, 0x33),
+    10: (0x00, 0x66, 0xff),
+}
+GRAY = (0x99, 0x99, 0x99)
+
+layouts = dict()    # KeyboardLayout by path
+
+
+# Return the KeyboardLayout of the layout file at path. The file is parsed
+# only when it is new or has been modified.
+def get_keyboard_layout(path: str):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = 0
+    model = layouts.get(path)
+    if not model or model.mtime != mtime:
+        model = KeyboardLayout(path, mtime)
+        layouts[path] = model
+    return model
+
+
+# KeyIndex is the index of a layout from each character on its keys to the
+# keys that type it. The index of the layout the IME uses also carries the
+# keyvals to ignore in touch counting and the kana typed with two keys, so
+# that the hints, touch counting and key counting share one index.
+class KeyIndex(dict):
+    def __init__(self, layout, ignore=()):
+        super().__init__(get_key_index(layout))
+        self.ignore = frozenset(ignore)
+        self.kogaki = frozenset(c for c in KOGAKI if c not in self)
+        self.two_keys = frozenset(DAKU + HANDAKU).union(self.kogaki)
 
 
 class Keyboard:
-    LAYOUT_104 = \
-        (((100, '`', '~'), (100, '1', '!'), (100, '2', '@'), (100, '3', '#'), (100, '4', '$'), (100, '5', '%'),
-          (100, '6', '^'), (100, '7', '&'), (100, '8', '*'), (100, '9', '('), (100, '0', ')'), (100, '-', '_'),
-          (100, '=', '+'), (200, '⌫', '')),
-         ((150, '⇥', ''), (100, 'q', 'Q'), (100, 'w', 'W'), (100, 'e', 'E'), (100, 'r', 'R'), (100, 't', 'T'),
-          (100, 'y', 'Y'), (100, 'u', 'U'), (100, 'i', 'I'), (100, 'o', 'O'), (100, 'p', 'P'),
-          (100, '[', '{'), (100, ']', '}'), (150, '\\', '|')),
-         ((175, '⇪', ''), (100, 'a', 'A'), (100, 's', 'S'), (100, 'd', 'D'), (100, 'f', 'F'), (100, 'g', 'G'),
-          (100, 'h', 'H'), (100, 'j', 'J'), (100, 'k', 'K'), (100, 'l', 'L'), (100, ';', ':'),
-          (100, '\'', '"'), (225, '⏎', '')),
-         ((225, '⇧', ''), (100, 'z', 'Z'), (100, 'x', 'X'), (100, 'c', 'C'), (100, 'v', 'V'), (100, 'b', 'B'),
-          (100, 'n', 'N'), (100, 'm', 'M'), (100, ',', '<'), (100, '.', '>'), (100, '/', '?'), (275, '⇧', '')),
-         ((125, '⌃', ''), (125, '❖', ''), (125, '⌥', ''), (625, ' ', ''),
-          (125, '⌥', ''), (125, '❖', ''), (125, '☰', ''), (125, '⌃', '')))
-    LAYOUT_109 = \
-        (((100, '🌍', ''), (100, '1', '!'), (100, '2', '"'), (100, '3', '#'), (100, '4', '$'), (100, '5', '%'),
-          (100, '6', '&'), (100, '7', '\''), (100, '8', '('), (100, '9', ')'), (100, '0', '_'), (100, '-', '='),
-          (100, '^', '~'), (100, '¥', '|'), (100, '⌫', '')),
-         ((150, '⇥', ''), (100, 'q', 'Q'), (100, 'w', 'W'), (100, 'e', 'E'), (100, 'r', 'R'), (100, 't', 'T'),
-          (100, 'y', 'Y'), (100, 'u', 'U'), (100, 'i', 'I'), (100, 'o', 'O'), (100, 'p', 'P'),
-          (100, '@', '`'), (100, '[', '{'), (150, '⏎', '')),
-         ((175, '⇪', ''), (100, 'a', 'A'), (100, 's', 'S'), (100, 'd', 'D'), (100, 'f', 'F'), (100, 'g', 'G'),
-          (100, 'h', 'H'), (100, 'j', 'J'), (100, 'k', 'K'), (100, 'l', 'L'), (100, ';', '+'),
-          (100, ':', '*'), (100, ']', '}')),
-         ((225, '⇧', ''), (100, 'z', 'Z'), (100, 'x', 'X'), (100, 'c', 'C'), (100, 'v', 'V'), (100, 'b', 'B'),
-          (100, 'n', 'N'), (100, 'm', 'M'), (100, ',', '<'), (100, '.', '>'), (100, '/', '?'), (100, '\\', '_'),
-          (175, '⇧', '')),
-         ((150, '⌃', ''), (125, '❖', ''), (125, '⌥', ''), (150, '無変換', ''), (250, ' ', ''),
-          (150, '変換', ''), (125, 'カタカナ', ''),
-          (100, '⌥', ''), (100, '❖', ''), (100, '☰', ''), (125, '⌃', '')))
+    LAYOUT_104 = LAYOUT_104
+    LAYOUT_109 = LAYOUT_109
     KEYVAL_MAP = {
         '⌃': 'Control_',
         '❖': 'Super_',
@@ -97,12 +102,21 @@ class Keyboard:
     L = 100
     S = 5
     DEG = math.pi / 180
+    SCALE = 0.4
+    # Bounds of the keyboard image relative to the position of the keyboard
+    IMAGE_LEFT = -110
+    IMAGE_TOP = -10
+    IMAGE_WIDTH = 830
+    IMAGE_HEIGHT = 260
 
     def __init__(self, roomazi: Roomazi):
         self.roomazi = roomazi
-        self.config = Gio.Settings.new(BASE_KEY)
-        self.load_keyboard_layout()
-        self.roomazi.set_x4063(self.config.get_boolean('nn-as-jis-x-4063'))
+        self.images = dict()
+        self.plan = (None, None)
+        self.monitor = None
+        self.monitor_path = ''
+        self.config = None
+        self.model = None
 
     def _draw_key(self, ctx, x, y, w, h, s, r, legend=''):
         self.round_rect(ctx, x + s, y + s, w - 2 * s, h - 2 * s, r)
@@ -115,196 +129,132 @@ class Keyboard:
             ctx.show_text(legend.upper())
             ctx.restore()
 
+    # Return the image of the keyboard without any hints, which is rendered
+    # once per layout and device scale.
+    def _get_image(self, ctx: cairo.Context, layout):
+        target = ctx.get_target()
+        scale_x, scale_y = target.get_device_scale()
+        key = (id(layout), scale_x, scale_y)
+        image = self.images.get(key)
+        if image:
+            return image[1:]
+        surface = target.create_similar_image(cairo.FORMAT_ARGB32,
+                                              math.ceil(Keyboard.IMAGE_WIDTH * scale_x),
+                                              math.ceil(Keyboard.IMAGE_HEIGHT * scale_y))
+        surface.set_device_scale(scale_x, scale_y)
+        image_ctx = cairo.Context(surface)
+        image_ctx.translate(-Keyboard.IMAGE_LEFT, -Keyboard.IMAGE_TOP)
+        image = (surface,) + self._render(image_ctx, layout)
+        if 4 <= len(self.images):
+            self.images.clear()
+        # Keep layout as well so that its id is not reused.
+        self.images[key] = (layout,) + image
+        return image
+
+    # Read the ibus-hiragana settings and the layout when they are used
+    # first.
+    def _get_model(self):
+        if self.model is None:
+            self.config = Gio.Settings.new(BASE_KEY)
+            self.config.connect('changed::layout', self.on_layout_changed)
+            self.config.connect('changed::nn-as-jis-x-4063', self.on_x4063_changed)
+            self.load_keyboard_layout()
+            self.roomazi.set_x4063(self.config.get_boolean('nn-as-jis-x-4063'))
+        return self.model
+
     # Is column the [Enter] key that spans two rows?
     def _is_uk_enter(self, column):
         return column[1] == '⏎' and column[0] == 150
 
-    def _load_kana_layout(self, path):
-        try:
-            with open(path) as f:
-                ime_layout = json.load(f)
-            space = ime_layout.get('Space')
-            prefix = ime_layout.get('Prefix', False)
-            if prefix:
-                self.ignore.append(Gdk.KEY_space)
-            henkan = ime_layout.get('Henkan')
-            if henkan:
-                henkan = Gdk.keyval_from_name(henkan)
-                self.ignore.append(henkan)
-                henkan = chr(henkan)
-            muhenkan = ime_layout.get('Muhenkan')
-            if muhenkan:
-                muhenkan = chr(Gdk.keyval_from_name(muhenkan))
-            underscore = ''
-            if ime_layout.get('Type') == 'Kana':
-                for r in self.layout:
-                    row = list()
-                    index = 0
-                    for c in r:
-                        n = c[1]
-                        s = c[2].lower()
-                        keyval = Keyboard.KEYVAL_MAP.get(n, '')
-                        if keyval:
-                            if 4 <= index:
-                                keyval += 'R'
-                            else:
-                                keyval += 'L'
-                        if s == '_':
-                            # Ignore the 2nd underscore
-                            if underscore:
-                                s = ''
-                            else:
-                                underscore = '_'
-                        if space == keyval:
-                            n = '\u3000'
-                        if n == ' ' and prefix:
-                            n = '⇧'
-                            s = ''
-                        elif n == '⇧' and prefix:
-                            n = ''
-                        elif n in (henkan, muhenkan):
-                            n = ''
-                        elif n in ime_layout['Normal']:
-                            n = ime_layout['Normal'][n]
-                        if s in (henkan, muhenkan):
-                            s = ''
-                        elif s in ime_layout['Shift']:
-                            s = ime_layout['Shift'][s]
-                        self.kogaki = self.kogaki.replace(n, '')
-                        self.kogaki = self.kogaki.replace(s, '')
-                        row.append((c[0], n, s))
-                        index += 1
-                    self.kana_layout.append(row)
-        except:
-            logger.error('Could not load:', path)
-            self.kana_layout = list()
-            self.kogaki = KOGAKI
-
-    def _load_roomazi_layout(self, path):
-        try:
-            with open(path) as f:
-                ime_layout = json.load(f)
-                layout = list()
-                space = ime_layout.get('Space')
-                henkan = ime_layout.get('Henkan')
-                if henkan:
-                    henkan = Gdk.keyval_from_name(henkan)
-                    self.ignore.append(henkan)
-                    henkan = chr(henkan)
-                for r in self.layout:
-                    row = list()
-                    index = 0
-                    for c in r:
-                        n = c[1]
-                        s = c[2].lower()
-                        keyval = Keyboard.KEYVAL_MAP.get(n, '')
-                        if keyval:
-                            if 4 <= index:
-                                keyval += 'R'
-                            else:
-                                keyval += 'L'
-                        if n == henkan:
-                            n = ''
-                        if space == keyval:
-                            n = ' '
-                        if ime_layout['Roomazi'].get(n, '') == '\u3000':
-                            n = ' '
-                        row.append((c[0], n, s))
-                        index += 1
-                    layout.append(row)
-                self.roomazi_layout = layout
-        except:
-            logger.error('Could not load:', path)
-
-    def draw(self, ctx: cairo.Context, x, y, next: str):
-        self.load_keyboard_layout()
-        if next and next[0].isascii():
-            self.draw_with_hint(ctx, x, y, self.layout, next[0])
-            pair = (next[0], next[0])
-        elif self.is_roomazi():
-            pair = self.roomazi.get_roomazi(next)
-            hint = pair[1]
-            hint = hint.replace('\u3000', ' ')
-            self.draw_with_hint(ctx, x, y, self.roomazi_layout, hint)
-        else:
-            pair = self.get_kana(next)
-            self.draw_with_hint(ctx, x, y, self.kana_layout, pair[1])
-        return pair
-
-    def draw_with_hint(self, ctx: cairo.Context, x, y, layout, hint=''):
+    def _make_plan(self, text):
+        steps = list()
+        for i, c in enumerate(text):
+            if c.isascii():
+                pair = (c, c)
+                layout = self._get_model().layout
+                hint = c
+            elif self.is_roomazi():
+                pair = self.roomazi.get_roomazi(text, i)
+                layout = self._get_model().roomazi_layout
+                hint = self.roomazi.hyphenize(pair[1].replace('\u3000', ' '))
+            else:
+                pair = self.get_kana(c)
+                layout = self._get_model().kana_layout
+                hint = pair[1]
+            index = self.get_key_index(layout)
+            keys = list()
+            for h in hint:
+                for row, column, finger, shift_key in index.get(h, ()):
+                    legend = h
+                    if shift_key == NO_SHIFT and h == '\u3000':
+                        legend = "空白"
+                    keys.append((row, column, finger, shift_key, legend))
+            steps.append((i + len(pair[0]), pair, layout, tuple(keys)))
         if self.is_roomazi():
-            hint = self.roomazi.hyphenize(hint)
-        ctx.move_to(x, y)
+            layout = self._get_model().roomazi_layout
+        else:
+            layout = self._get_model().kana_layout
+        return KeystrokePlan(steps, (len(text), ('', ''), layout, ()))
+
+    def _monitor(self, path):
+        if path == self.monitor_path:
+            return
+        if self.monitor:
+            self.monitor.cancel()
+            self.monitor = None
+        self.monitor_path = path
+        try:
+            self.monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            self.monitor.connect('changed', self.on_layout_file_changed)
+        except Exception as e:
+            logger.error(str(e))
+
+    # Render the keyboard at (0, 0) and return where the keys, the shift keys
+    # and the finger tips are.
+    def _render(self, ctx: cairo.Context, layout):
+        x = y = 0
         ctx.set_line_width(1)
         ctx.set_line_join(cairo.LineJoin.ROUND)
-        scale = 0.4
+        scale = Keyboard.SCALE
         orig_x = x
         orig_y = y
         h = Keyboard.L * scale
         r = Keyboard.R * scale
         s = Keyboard.S * scale
+        keys = dict()
         shift = list()
-        shift_left = False
-        shift_right = False
-        alt = list()
         index_raw = 0
-        fingers = list()
         for raw in layout:
             index_column = 0
             for column in raw:
                 if column[1] == '⇧':
                     shift.append((x, y, column))
-                if column[1] == '⌥':
-                    alt.append((x, y, column))
                 w = column[0] * scale
                 color = self.get_key_color(index_column)
                 if index_raw <= 0 or 4 <= index_raw:
-                    color = (0x99, 0x99, 0x99)
-                ctx.set_source_rgb(*[c / 255 for c in color])
+                    color = GRAY
+                rgb = [c / 255 for c in color]
+                ctx.set_source_rgb(*rgb)
                 if self._is_uk_enter(column):
                     self.uk_enter(ctx, x, y, w, h, s, r)
                 else:
                     self.round_rect(ctx, x + s, y + s, w - 2 * s, h - 2 * s, r)
                 ctx.stroke()
-                for c in hint:
-                    if c in column[1]:
-                        if index_raw < 4:
-                            fingers.append(index_column)
-                        if c == '\u3000':
-                            c = "空白"
-                        self._draw_key(ctx, x, y, w, h, s, r, c)
-                    elif c in column[2]:
-                        if index_raw < 4:
-                            fingers.append(index_column)
-                        self._draw_key(ctx, x, y, w, h, s, r, c)
-                        if index_column <= 5:
-                            shift_right = True
-                        else:
-                            shift_left = True
+                keys[(index_raw, index_column)] = (x, y, w, rgb)
                 x += w
                 index_column += 1
             index_raw += 1
             x = orig_x
             y += h
-        if shift_right:
-            if 2 <= len(shift):
-                self._draw_key(ctx, shift[1][0], shift[1][1], shift[1][2][0] * scale, h, s, r, 'シフト')
-            else:
-                self._draw_key(ctx, shift[0][0], shift[0][1], shift[0][2][0] * scale, h, s, r, 'シフト')
-        if shift_left:
-            self._draw_key(ctx, shift[0][0], shift[0][1], shift[0][2][0] * scale, h, s, r, 'シフト')
 
         # draw fingers
-        if 5 in fingers:
-            fingers.append(4)
-        if 6 in fingers:
-            fingers.append(7)
+        circles = list()
         metrics = [(1, 25, 8), (2, 45, 10), (3, 60, 10), (4, 45, 10), (7, 45, 10), (8, 60, 10), (9, 45, 10), (10, 25, 8)]
         x = orig_x - 100
         y = orig_y + 4.5 * Keyboard.L * scale
         for m in metrics:
             r = m[2]
-            ctx.set_source_rgb(*[c / 255 for c in (0x99, 0x99, 0x99)])
+            ctx.set_source_rgb(*[c / 255 for c in GRAY])
             ctx.move_to(x, y)
             y -= m[1]
             ctx.line_to(x, y)
@@ -313,15 +263,10 @@ class Keyboard:
             x += 2 * r
             ctx.line_to(x, y)
             ctx.stroke()
-            if m[0] in fingers:
-                color = self.get_key_color(m[0])
-                ctx.set_source_rgb(*[c / 255 for c in color])
-                ctx.arc(x - r, y - m[1] + 1, r * 0.8, 0 * Keyboard.DEG, 360 * Keyboard.DEG)
-                ctx.fill()
+            circles.append((m[0], x - r, y - m[1] + 1, r * 0.8))
             if m[0] != 4:
                 x += 5
             else:
-                ctx.set_source_rgb(*[c / 255 for c in (0x99, 0x99, 0x99)])
                 # draw thumbs
                 ctx.move_to(x, y)
                 y += 30
@@ -353,6 +298,66 @@ class Keyboard:
                 x = orig_x + 1500 * scale + 7
 
             y = orig_y + 4.5 * Keyboard.L * scale
+        return keys, shift, circles
+
+    # Draw the keyboard with the hint for the keystroke at offset in plan,
+    # outlining the keys of the next lookahead keystrokes.
+    def draw(self, ctx: cairo.Context, x, y, plan, offset, lookahead=0):
+        end, pair, layout, keys = plan.get_step(offset)
+        self.draw_with_hint(ctx, x, y, layout, keys, plan.get_lookahead(end, lookahead))
+        return pair
+
+    def draw_with_hint(self, ctx: cairo.Context, x, y, layout, hint=(), lookahead=()):
+        surface, keys, shift, circles = self._get_image(ctx, layout)
+        ctx.save()
+        ctx.set_source_surface(surface, x + Keyboard.IMAGE_LEFT, y + Keyboard.IMAGE_TOP)
+        ctx.paint()
+        ctx.restore()
+
+        ctx.set_line_width(1)
+        ctx.set_line_join(cairo.LineJoin.ROUND)
+        scale = Keyboard.SCALE
+        h = Keyboard.L * scale
+        r = Keyboard.R * scale
+        s = Keyboard.S * scale
+        shift_left = False
+        shift_right = False
+        fingers = set()
+        for row, column, finger, shift_key, legend in hint:
+            kx, ky, w, rgb = keys[(row, column)]
+            if finger:
+                fingers.add(finger)
+            if shift_key == SHIFT_RIGHT:
+                shift_right = True
+            elif shift_key == SHIFT_LEFT:
+                shift_left = True
+            ctx.set_source_rgb(*rgb)
+            self._draw_key(ctx, x + kx, y + ky, w, h, s, r, legend)
+        for row, column, finger, shift_key, legend in lookahead:
+            kx, ky, w, rgb = keys[(row, column)]
+            ctx.set_source_rgb(*rgb)
+            self.round_rect(ctx, x + kx + s, y + ky + s, w - 2 * s, h - 2 * s, r)
+            ctx.stroke()
+        ctx.set_source_rgb(*[c / 255 for c in GRAY])
+        if shift_right:
+            if 2 <= len(shift):
+                self._draw_key(ctx, x + shift[1][0], y + shift[1][1], shift[1][2][0] * scale, h, s, r, 'シフト')
+            else:
+                self._draw_key(ctx, x + shift[0][0], y + shift[0][1], shift[0][2][0] * scale, h, s, r, 'シフト')
+        if shift_left:
+            self._draw_key(ctx, x + shift[0][0], y + shift[0][1], shift[0][2][0] * scale, h, s, r, 'シフト')
+
+        # draw fingers
+        if 5 in fingers:
+            fingers.add(4)
+        if 6 in fingers:
+            fingers.add(7)
+        for finger, cx, cy, r in circles:
+            if finger in fingers:
+                color = self.get_key_color(finger)
+                ctx.set_source_rgb(*[c / 255 for c in color])
+                ctx.arc(x + cx, y + cy, r, 0 * Keyboard.DEG, 360 * Keyboard.DEG)
+                ctx.fill()
 
     def get_kana(self, s):
         if not s:
@@ -366,62 +371,66 @@ class Keyboard:
         elif c in HANDAKU:
             c = c.translate(HANDAKU_TO_NON_HANDAKU)
             c += '゜'
-        elif c in self.kogaki:
+        elif c in self._get_model().index.kogaki:
             c = c.translate(KOGAKI_TO_NON_KOGAKI)
             c += '゛'
         return s[0], c
 
     def get_key_color(self, column):
-        return {
-            1: (0x00, 0x66, 0xff),
-            2: (0x99, 0xcc, 0x33),
-            3: (0xff, 0x99, 0x33),
-            4: (0xff, 0x33, 0x33),
-            5: (0xff, 0x33, 0x33),
-            6: (0xff, 0x33, 0x33),
-            7: (0xff, 0x33, 0x33),
-            8: (0xff, 0x99, 0x33),
-            9: (0x99, 0xcc, 0x33),
-            10: (0x00, 0x66, 0xff),
-        }.get(column, (0x99, 0x99, 0x99))
-
-    def get_key_count(self, reading: str):
+        return KEY_COLORS.get(column, GRAY)
+
+    def get_key_index(self, layout):
+        index = self._get_model().indexes.get(id(layout))
+        if index is None:
+            index = KeyIndex(layout)
+        return index
+
+    # Return the KeystrokePlan of text for the current layout. The plan of
+    # the last text is kept until the text or the layout changes.
+    def get_plan(self, text: str):
+        model = self._get_model()
+        key = (text, model.layout, model.roomazi_layout, model.kana_layout, self.roomazi.x4063)
+        if self.plan[0] != key:
+            self.plan = (key, self._make_plan(text))
+        return self.plan[1]
+
+    # counts are the key counts of the reading with the roomazi layouts
+    # precomputed in the lesson bundle, if any.
+    def get_key_count(self, reading: str, counts=None):
         if self.is_roomazi():
-            reading = self.roomazi.hyphenize(self.roomazi.romanize(reading))
-            count = len(reading)
-            if reading and reading[-1] == 'n':
-                count += 1
-        else:
-            r = ''
-            while reading:
-                pair = self.get_kana(reading)
-                reading = reading[len(pair[0]):]
-                r += pair[1]
-            count = len(r)
-        return count
+            if counts:
+                return counts['roomazi-x4063' if self.roomazi.x4063 else 'roomazi']
+            return self.roomazi.get_key_count(reading)
+        return count_kana_keys(reading, self._get_model().index.two_keys)
+
+    # Return the layout model if it has been loaded, or None.
+    def get_loaded_model(self):
+        return self.model
 
     def is_ignore(self, event):
-        if event.keyval in self.ignore:
-            return True
-        return False
+        return event.keyval in self._get_model().index.ignore
 
     def is_roomazi(self):
-        return not self.kana_layout
+        return not self._get_model().kana_layout
 
+    # Load the layout selected in the ibus-hiragana settings.
     def load_keyboard_layout(self):
         path = self.config.get_string('layout')
-        if path.endswith('.109.json'):
-            self.layout = Keyboard.LAYOUT_109
-        else:
-            self.layout = Keyboard.LAYOUT_104
-        self.roomazi_layout = list()
-        self.kana_layout = list()
-        self.kogaki = KOGAKI
-        self.ignore = [Gdk.KEY_VoidSymbol]
-        if "roomazi" in path:
-            self._load_roomazi_layout(path)
-        else:
-            self._load_kana_layout(path)
+        self.model = get_keyboard_layout(path)
+        self._monitor(path)
+
+    def on_layout_changed(self, settings, key):
+        logger.info('layout: %s', settings.get_string(key))
+        self.load_keyboard_layout()
+
+    def on_layout_file_changed(self, monitor, file, other_file, event_type):
+        if event_type in (Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                          Gio.FileMonitorEvent.CREATED,
+                          Gio.FileMonitorEvent.DELETED):
+            self.load_keyboard_layout()
+
+    def on_x4063_changed(self, settings, key):
+        self.roomazi.set_x4063(settings.get_boolean(key))
 
     def round_rect(self, ctx, x, y, w, h, r):
         ctx.new_path()
@@ -431,6 +440,17 @@ class Keyboard:
         ctx.arc(x + r, y + r, r, 180 * Keyboard.DEG, 270 * Keyboard.DEG)
         ctx.close_path()
 
+    # Load the layout and render the keyboard images for the device scale
+    # before they are drawn first.
+    def warm_up(self, scale=1):
+        model = self._get_model()
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+        surface.set_device_scale(scale, scale)
+        ctx = cairo.Context(surface)
+        for layout in (model.layout, model.roomazi_layout, model.kana_layout):
+            if layout:
+                self._get_image(ctx, layout)
+
     def uk_enter(self, ctx, x, y, w, h, s, r):
         x1 = x + s
         y1 = y + s
@@ -446,3 +466,161 @@ class Keyboard:
         ctx.arc(x1 + r, y1 + h1 - r, r, 90 * Keyboard.DEG, 180 * Keyboard.DEG)
         ctx.arc(x1 + r, y1 + r, r, 180 * Keyboard.DEG, 270 * Keyboard.DEG)
         ctx.close_path()
+
+
+# KeyboardLayout is the parsed ibus-hiragana layout file at path, which is
+# shared by every Keyboard through get_keyboard_layout(). The instances are
+# immutable once created. index is the KeyIndex of the layout the IME uses,
+# and indexes maps the id of each layout to its KeyIndex.
+class KeyboardLayout:
+    __slots__ = ('path', 'mtime', 'layout', 'roomazi_layout', 'kana_layout', 'index', 'indexes')
+
+    def __init__(self, path, mtime):
+        if path.endswith('.109.json'):
+            layout = Keyboard.LAYOUT_109
+        else:
+            layout = Keyboard.LAYOUT_104
+        ignore = {Gdk.KEY_VoidSymbol}
+        roomazi_layout = ()
+        kana_layout = ()
+        object.__setattr__(self, 'layout', layout)
+        if "roomazi" in path:
+            roomazi_layout = self._load_roomazi_layout(path, ignore)
+        else:
+            kana_layout = self._load_kana_layout(path, ignore)
+        index = KeyIndex(kana_layout or roomazi_layout, ignore)
+        indexes = {id(layout): KeyIndex(layout)}
+        if kana_layout or roomazi_layout:
+            indexes[id(kana_layout or roomazi_layout)] = index
+        for name, value in (('path', path),
+                            ('mtime', mtime),
+                            ('roomazi_layout', roomazi_layout),
+                            ('kana_layout', kana_layout),
+                            ('index', index),
+                            ('indexes', indexes)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("KeyboardLayout is immutable")
+
+    def _load_kana_layout(self, path, ignore):
+        kana_layout = list()
+        try:
+            with open(path) as f:
+                ime_layout = json.load(f)
+            space = ime_layout.get('Space')
+            prefix = ime_layout.get('Prefix', False)
+            if prefix:
+                ignore.add(Gdk.KEY_space)
+            henkan = ime_layout.get('Henkan')
+            if henkan:
+                henkan = Gdk.keyval_from_name(henkan)
+                ignore.add(henkan)
+                henkan = chr(henkan)
+            muhenkan = ime_layout.get('Muhenkan')
+            if muhenkan:
+                muhenkan = chr(Gdk.keyval_from_name(muhenkan))
+            underscore = ''
+            if ime_layout.get('Type') == 'Kana':
+                for r in self.layout:
+                    row = list()
+                    index = 0
+                    for c in r:
+                        n = c[1]
+                        s = c[2].lower()
+                        keyval = Keyboard.KEYVAL_MAP.get(n, '')
+                        if keyval:
+                            if 4 <= index:
+                                keyval += 'R'
+                            else:
+                                keyval += 'L'
+                        if s == '_':
+                            # Ignore the 2nd underscore
+                            if underscore:
+                                s = ''
+                            else:
+                                underscore = '_'
+                        if space == keyval:
+                            n = '\u3000'
+                        if n == ' ' and prefix:
+                            n = '⇧'
+                            s = ''
+                        elif n == '⇧' and prefix:
+                            n = ''
+                        elif n in (henkan, muhenkan):
+                            n = ''
+                        elif n in ime_layout['Normal']:
+                            n = ime_layout['Normal'][n]
+                        if s in (henkan, muhenkan):
+                            s = ''
+                        elif s in ime_layout['Shift']:
+                            s = ime_layout['Shift'][s]
+                        row.append((c[0], n, s))
+                        index += 1
+                    kana_layout.append(tuple(row))
+        except:
+            logger.error('Could not load: %s', path)
+            kana_layout = list()
+        return tuple(kana_layout)
+
+    def _load_roomazi_layout(self, path, ignore):
+        layout = list()
+        try:
+            with open(path) as f:
+                ime_layout = json.load(f)
+                space = ime_layout.get('Space')
+                henkan = ime_layout.get('Henkan')
+                if henkan:
+                    henkan = Gdk.keyval_from_name(henkan)
+                    ignore.add(henkan)
+                    henkan = chr(henkan)
+                for r in self.layout:
+                    row = list()
+                    index = 0
+                    for c in r:
+                        n = c[1]
+                        s = c[2].lower()
+                        keyval = Keyboard.KEYVAL_MAP.get(n, '')
+                        if keyval:
+                            if 4 <= index:
+                                keyval += 'R'
+                            else:
+                                keyval += 'L'
+                        if n == henkan:
+                            n = ''
+                        if space == keyval:
+                            n = ' '
+                        if ime_layout['Roomazi'].get(n, '') == '\u3000':
+                            n = ' '
+                        row.append((c[0], n, s))
+                        index += 1
+                    layout.append(tuple(row))
+        except:
+            logger.error('Could not load: %s', path)
+            layout = list()
+        return tuple(layout)
+
+
+# KeystrokePlan maps each offset in a practice text to the keystroke typed
+# next there: the end offset of the characters it types, the pair of the
+# characters and their keys, the layout, and the keys to highlight as
+# (row, column, finger, shift, legend).
+class KeystrokePlan:
+    def __init__(self, steps, last):
+        self.steps = steps
+        self.last = last
+
+    def get_lookahead(self, offset, count):
+        keys = list()
+        for i in range(count):
+            if len(self.steps) <= offset:
+                break
+            step = self.steps[offset]
+            keys.extend(step[3])
+            offset = step[0]
+        return keys
+
+    def get_step(self, offset):
+        if offset < len(self.steps):
+            return self.steps[offset]
+        return self.last
@@ -0,0 +1,96 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module holds the keyboard tables and the key counting that do not
+# depend on gi, so that lessoncheck.py can use them on a build host without
+# GTK.
+
+import functools
+
+MAX_KEY_COUNTS = 1024
+
+# Which shift key to use with a key
+NO_SHIFT = 0
+SHIFT_LEFT = 1
+SHIFT_RIGHT = 2
+
+DAKU = 'がぎぐげござじずぜぞだぢづでどばびぶべぼゔ'
+NON_DAKU = 'かきくけこさしすせそたちつてとはひふへほう'
+
+HANDAKU = 'ぱぴぷぺぽ'
+NON_HANDALU = 'はひふへほ'
+
+KOGAKI = 'ぁぃぅぇぉゃゅょっ'
+NON_KOGAKI = 'あいうえおやゆよつ'
+
+DAKU_TO_NON_DAKU = str.maketrans(DAKU, NON_DAKU)
+HANDAKU_TO_NON_HANDAKU = str.maketrans(HANDAKU, NON_HANDALU)
+KOGAKI_TO_NON_KOGAKI = str.maketrans(KOGAKI, NON_KOGAKI)
+
+LAYOUT_104 = \
+    (((100, '`', '~'), (100, '1', '!'), (100, '2', '@'), (100, '3', '#'), (100, '4', '$'), (100, '5', '%'),
+      (100, '6', '^'), (100, '7', '&'), (100, '8', '*'), (100, '9', '('), (100, '0', ')'), (100, '-', '_'),
+      (100, '=', '+'), (200, '⌫', '')),
+     ((150, '⇥', ''), (100, 'q', 'Q'), (100, 'w', 'W'), (100, 'e', 'E'), (100, 'r', 'R'), (100, 't', 'T'),
+      (100, 'y', 'Y'), (100, 'u', 'U'), (100, 'i', 'I'), (100, 'o', 'O'), (100, 'p', 'P'),
+      (100, '[', '{'), (100, ']', '}'), (150, '\\', '|')),
+     ((175, '⇪', ''), (100, 'a', 'A'), (100, 's', 'S'), (100, 'd', 'D'), (100, 'f', 'F'), (100, 'g', 'G'),
+      (100, 'h', 'H'), (100, 'j', 'J'), (100, 'k', 'K'), (100, 'l', 'L'), (100, ';', ':'),
+      (100, '\'', '"'), (225, '⏎', '')),
+     ((225, '⇧', ''), (100, 'z', 'Z'), (100, 'x', 'X'), (100, 'c', 'C'), (100, 'v', 'V'), (100, 'b', 'B'),
+      (100, 'n', 'N'), (100, 'm', 'M'), (100, ',', '<'), (100, '.', '>'), (100, '/', '?'), (275, '⇧', '')),
+     ((125, '⌃', ''), (125, '❖', ''), (125, '⌥', ''), (625, ' ', ''),
+      (125, '⌥', ''), (125, '❖', ''), (125, '☰', ''), (125, '⌃', '')))
+LAYOUT_109 = \
+    (((100, '🌍', ''), (100, '1', '!'), (100, '2', '"'), (100, '3', '#'), (100, '4', '$'), (100, '5', '%'),
+      (100, '6', '&'), (100, '7', '\''), (100, '8', '('), (100, '9', ')'), (100, '0', '_'), (100, '-', '='),
+      (100, '^', '~'), (100, '¥', '|'), (100, '⌫', '')),
+     ((150, '⇥', ''), (100, 'q', 'Q'), (100, 'w', 'W'), (100, 'e', 'E'), (100, 'r', 'R'), (100, 't', 'T'),
+      (100, 'y', 'Y'), (100, 'u', 'U'), (100, 'i', 'I'), (100, 'o', 'O'), (100, 'p', 'P'),
+      (100, '@', '`'), (100, '[', '{'), (150, '⏎', '')),
+     ((175, '⇪', ''), (100, 'a', 'A'), (100, 's', 'S'), (100, 'd', 'D'), (100, 'f', 'F'), (100, 'g', 'G'),
+      (100, 'h', 'H'), (100, 'j', 'J'), (100, 'k', 'K'), (100, 'l', 'L'), (100, ';', '+'),
+      (100, ':', '*'), (100, ']', '}')),
+     ((225, '⇧', ''), (100, 'z', 'Z'), (100, 'x', 'X'), (100, 'c', 'C'), (100, 'v', 'V'), (100, 'b', 'B'),
+      (100, 'n', 'N'), (100, 'm', 'M'), (100, ',', '<'), (100, '.', '>'), (100, '/', '?'), (100, '\\', '_'),
+      (175, '⇧', '')),
+     ((150, '⌃', ''), (125, '❖', ''), (125, '⌥', ''), (150, '無変換', ''), (250, ' ', ''),
+      (150, '変換', ''), (125, 'カタカナ', ''),
+      (100, '⌥', ''), (100, '❖', ''), (100, '☰', ''), (125, '⌃', '')))
+
+
+# Count the keystrokes of the reading with a kana layout, where two_keys is
+# the set of the kana typed with two keys in the layout.
+@functools.lru_cache(maxsize=MAX_KEY_COUNTS)
+def count_kana_keys(reading: str, two_keys: frozenset):
+    return len(reading) + sum(1 for c in reading if c in two_keys)
+
+
+# Map each character on the keys of layout to the tuple of the keys that
+# type it. Each key is (row, column, finger, shift), where finger is 0 for
+# the keys not in the four main rows.
+def get_key_index(layout):
+    index = dict()
+    for row, keys in enumerate(layout):
+        for column, key in enumerate(keys):
+            finger = column if row < 4 else 0
+            for c in key[1]:
+                index.setdefault(c, list()).append((row, column, finger, NO_SHIFT))
+            shift = SHIFT_RIGHT if column <= 5 else SHIFT_LEFT
+            for c in key[2]:
+                if c not in key[1]:
+                    index.setdefault(c, list()).append((row, column, finger, shift))
+    return {c: tuple(keys) for c, keys in index.items()}
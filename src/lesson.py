@@ -0,0 +1,323 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module does not depend on gi so that the lesson bundle can be built
+# with python3 alone:
+#
+#   python3 lesson.py [-r ROOT] -o lessons.bundle menu.txt aiueo.txt ...
+
+from roomazi import Roomazi
+
+import argparse
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+logger = logging.getLogger(__name__)
+
+IAA = '\uFFF9'  # IAA (INTERLINEAR ANNOTATION ANCHOR)
+IAS = '\uFFFA'  # IAS (INTERLINEAR ANNOTATION SEPARATOR)
+IAT = '\uFFFB'  # IAT (INTERLINEAR ANNOTATION TERMINATOR)
+
+PLAIN = 0
+BASE = 1
+RUBY = 2
+
+HIRAGANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをんゔがぎぐげござじずぜぞだぢづでどばびぶべぼぁぃぅぇぉゃゅょっぱぴぷぺぽゎゐゑ・ーゝゞ"
+KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワヲンヴガギグゲゴザジズゼゾダヂヅデドバビブベボァィゥェォャュョッパピプペポヮヰヱ・ーヽヾ"
+TO_HIRAGANA = str.maketrans(KATAKANA, HIRAGANA)
+
+# The lesson bundle starts with the header below, followed by the lesson
+# files as they are, and the JSON index at index_offset:
+#
+#   magic, version, index_offset, index_size
+#
+# The index maps the path of each lesson file relative to the lessons root,
+# where the bundle is installed, to the offset and the size of the file and
+# to its LessonInfo, and each text in the lessons to its plain
+# text, its reading and its key counts with the roomazi layouts.
+BUNDLE_NAME = 'lessons.bundle'
+BUNDLE_MAGIC = b'TPLB'
+BUNDLE_VERSION = 2
+BUNDLE_HEADER = struct.Struct('<4sIQQ')
+
+
+def get_plain_text(text: str):
+    plain = ''
+    reading = ''
+    mode = PLAIN
+    for c in text:
+        if c == IAA:
+            mode = BASE
+        elif c == IAS:
+            mode = RUBY
+        elif c == IAT:
+            mode = PLAIN
+        elif mode == BASE:
+            plain += c
+        elif mode == RUBY:
+            reading += c
+        else:
+            plain += c
+            reading += c
+    return plain, reading.translate(TO_HIRAGANA)
+
+
+# Split the content of a lesson file into lines as readlines() does.
+def split_lines(content: bytes):
+    return io.StringIO(content.decode(), newline=None).readlines()
+
+
+# Return the texts of the :text blocks in lines as Engine.run() reads them.
+def get_texts(lines):
+    texts = list()
+    text = None
+    for line in lines:
+        if not line.startswith(':'):
+            if text is not None:
+                text += line
+            continue
+        if text:
+            texts.append(text.rstrip())
+        text = '' if line.startswith(':text') else None
+    return texts
+
+
+# Return the key counts of the reading with the roomazi layouts.
+def get_key_counts(reading: str):
+    counts = dict()
+    roomazi = Roomazi()
+    for x4063, name in ((False, 'roomazi'), (True, 'roomazi-x4063')):
+        roomazi.set_x4063(x4063)
+        counts[name] = roomazi.get_key_count(reading)
+    return counts
+
+
+# Summarize the lesson in lines for the menus. get_text returns the plain
+# text, the reading and the key counts of a text. Since only n lines of the
+# text before ':random n' are practiced, its share is estimated pro rata.
+def get_lesson_info(lines, get_text=None):
+    title = ''
+    ime_mode = ''
+    next = None
+    menu = ()
+    texts = list()  # [plain, reading, counts, ratio]
+    text = None
+    for line in lines:
+        if not line.startswith(':'):
+            if text is not None:
+                text += line
+            continue
+        if text:
+            texts.append(list(_get_text(text.rstrip(), get_text)) + [1])
+        text = '' if line.startswith(':text') else None
+        if line.startswith(':title ') and not title:
+            title = line[len(':title '):].strip()
+        elif line.startswith(':ime_mode') and not ime_mode:
+            ime_mode = line[len(':ime_mode'):].strip()
+        elif line.startswith(':next'):
+            next = line[len(':next'):].strip()
+        elif line.startswith(':menu'):
+            menu = tuple(line[len(':menu'):].split())
+        elif line.startswith(':random') and texts:
+            count = len(texts[-1][0].splitlines())
+            n = line[len(':random'):].strip()
+            if n.isdigit() and count:
+                texts[-1][3] = min(max(1, int(n)), count) / count
+    if text:
+        texts.append(list(_get_text(text.rstrip(), get_text)) + [1])
+    size = 0
+    reading = ''
+    counts = dict()
+    for plain, r, c, ratio in texts:
+        size += round(len(plain) * ratio)
+        reading += r[:round(len(r) * ratio)]
+        for name, count in c.items():
+            counts[name] = counts.get(name, 0) + round(count * ratio)
+    return LessonInfo(title, ime_mode or 'A', size, reading, counts, next, menu)
+
+
+def _get_text(text, get_text):
+    info = get_text(text) if get_text else None
+    if info:
+        return info
+    plain, reading = get_plain_text(text)
+    return plain, reading, get_key_counts(reading)
+
+
+# Return the name of the lesson file at path in the bundle, i.e., its path
+# relative to root, or None if the file is not under root.
+def get_bundle_name(path, root):
+    name = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    if name == os.pardir or name.startswith(os.pardir + os.sep):
+        return None
+    return name
+
+
+# Compile the lesson files in paths into the bundle at output, where the
+# lessons are named by their paths relative to root. texts may give the
+# plain text, the reading and the key counts of the texts counted in
+# advance. Raise ValueError if a lesson file is not under root, or if two
+# paths name the same lesson.
+def compile_bundle(paths, output, texts=None, root=os.curdir):
+    lessons = dict()
+    catalog = dict()
+    texts = dict(texts) if texts else dict()
+    data = list()
+    offset = BUNDLE_HEADER.size
+    for path in paths:
+        name = get_bundle_name(path, root)
+        if name is None:
+            raise ValueError('"%s" is not under "%s".' % (path, root))
+        if name in lessons:
+            raise ValueError('"%s" is listed more than once.' % name)
+        with open(path, 'rb') as file:
+            content = file.read()
+        lessons[name] = (offset, len(content))
+        data.append(content)
+        offset += len(content)
+        lines = split_lines(content)
+        for text in get_texts(lines):
+            if text not in texts:
+                plain, reading = get_plain_text(text)
+                texts[text] = (plain, reading, get_key_counts(reading))
+        catalog[name] = get_lesson_info(lines, texts.get).to_list()
+    index = json.dumps({'lessons': lessons, 'catalog': catalog, 'texts': texts}, ensure_ascii=False).encode()
+    with open(output, 'wb') as file:
+        file.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, offset, len(index)))
+        for content in data:
+            file.write(content)
+        file.write(index)
+
+
+# Open the lesson bundle at path. Return None if it is not available.
+def open_bundle(path):
+    try:
+        return LessonBundle(path)
+    except (OSError, ValueError) as e:
+        logger.info('lesson bundle: %s', e)
+        return None
+
+
+# LessonBundle reads the lessons from the memory-mapped bundle file.
+class LessonBundle:
+    def __init__(self, path):
+        self.path = path
+        self.dirname = os.path.dirname(os.path.abspath(path))
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < BUNDLE_HEADER.size:
+            raise ValueError('"%s" is too short.' % path)
+        magic, version, offset, size = BUNDLE_HEADER.unpack_from(self.map)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            raise ValueError('"%s" is not a lesson bundle of version %d.' % (path, BUNDLE_VERSION))
+        index = json.loads(self.map[offset:offset + size].decode())
+        self.lessons = index['lessons']
+        self.catalog = index['catalog']
+        self.texts = index['texts']
+
+    def close(self):
+        self.map.close()
+
+    # Return the LessonInfo of the lesson at path, or None if the lesson is
+    # not in the bundle.
+    def get_info(self, path):
+        name = get_bundle_name(path, self.dirname)
+        values = self.catalog.get(name) if name else None
+        if not values:
+            return None
+        return LessonInfo(*values)
+
+    # Return the lines of the lesson at path, or None if the lesson is not
+    # in the bundle.
+    def get_lines(self, path):
+        name = get_bundle_name(path, self.dirname)
+        lesson = self.lessons.get(name) if name else None
+        if not lesson:
+            return None
+        offset, size = lesson
+        return split_lines(self.map[offset:offset + size])
+
+    # Return the plain text, the reading and the key counts of text, or None
+    # if text is not in the bundle.
+    def get_text(self, text):
+        return self.texts.get(text)
+
+
+# LessonCatalog keeps the LessonInfo of the lessons by path so that the menus
+# can show them without reading the lesson files. The info of a lesson file
+# is updated whenever the file is read again after it has been modified, as
+# told by its etag.
+class LessonCatalog:
+    def __init__(self, bundle=None):
+        self.bundle = bundle
+        self.entries = dict()   # (version, LessonInfo) by path
+
+    def get(self, path):
+        entry = self.entries.get(path)
+        if entry:
+            return entry[1]
+        info = self.bundle.get_info(path) if self.bundle else None
+        if info:
+            self.entries[path] = (0, info)
+        return info
+
+    def update(self, path, version, lines):
+        entry = self.entries.get(path)
+        if not entry or entry[0] != version:
+            self.entries[path] = (version, get_lesson_info(lines))
+
+
+# LessonInfo summarizes a lesson: its title, the IME mode it starts with,
+# the number of the characters and the reading of its texts, the key counts
+# of the reading with the roomazi layouts, the lesson that follows it ('' for
+# the next one in the menu, None for none) and the lessons in its menu.
+class LessonInfo:
+    __slots__ = ('title', 'ime_mode', 'size', 'reading', 'counts', 'next', 'menu')
+
+    def __init__(self, title='', ime_mode='A', size=0, reading='', counts=None, next=None, menu=()):
+        self.title = title
+        self.ime_mode = ime_mode
+        self.size = size
+        self.reading = reading
+        self.counts = counts if counts is not None else dict()
+        self.next = next
+        self.menu = tuple(menu)
+
+    def to_list(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile lessons into a lesson bundle.')
+    parser.add_argument('-o', '--output', default=BUNDLE_NAME, help='the bundle file to write')
+    parser.add_argument('-r', '--root', default=os.curdir, help='the lessons directory to name the lessons from')
+    parser.add_argument('lessons', nargs='+', help='the lesson files')
+    args = parser.parse_args()
+    try:
+        compile_bundle(args.lessons, args.output, root=args.root)
+    except (OSError, ValueError) as e:
+        print('%s: %s' % (parser.prog, e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
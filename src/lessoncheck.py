@@ -0,0 +1,240 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module checks the lesson files without playing them:
+#
+#   python3 lessoncheck.py [-j JOBS] [-v] [-o lessons.bundle [-r lessons/]] lessons/
+#
+# The lesson files are checked in parallel by a pool of processes. Each
+# :text is run through get_plain_text(), the roomazi conversion and the key
+# counting with both x4063 settings, and the keys to type are looked up on
+# both the 104 and the 109 keyboards. Then the :menu and :next targets are
+# checked. If no errors are found, the texts counted meanwhile can be
+# written into the lesson bundle.
+
+from keymap import DAKU, HANDAKU, KOGAKI, LAYOUT_104, LAYOUT_109, count_kana_keys
+from lesson import IAA, IAS, IAT, compile_bundle, get_key_counts, get_plain_text, split_lines
+from roomazi import ZENKAKU_TO_HANKAKU, Roomazi
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+
+DIRECTIVES = frozenset(('title', 'text', 'hint', 'ime_mode', 'keyboard', 'random', 'start',
+                        'show_score', 'up', 'next', 'menu', 'zenkaku'))
+MENU_COMMANDS = frozenset(('stats', 'up', 'quit'))
+TWO_KEYS = frozenset(DAKU + HANDAKU + KOGAKI)
+
+
+def get_keys(layout):
+    keys = {'\n'}
+    for row in layout:
+        for key in row:
+            keys.update(key[1])
+            keys.update(key[2])
+    return frozenset(keys)
+
+
+KEYBOARDS = (('104', get_keys(LAYOUT_104)), ('109', get_keys(LAYOUT_109)))
+
+
+# Return the error in the ruby marks of text, or '' if they are balanced.
+def check_ruby(text):
+    state = IAT
+    base = ruby = 0
+    for c in text:
+        if c == IAA:
+            if state != IAT:
+                return 'IAA (U+FFF9) inside a ruby'
+            base = 0
+        elif c == IAS:
+            if state != IAA:
+                return 'IAS (U+FFFA) without IAA (U+FFF9)'
+            if not base:
+                return 'empty ruby base'
+            ruby = 0
+        elif c == IAT:
+            if state != IAS:
+                return 'IAT (U+FFFB) without IAS (U+FFFA)'
+            if not ruby:
+                return 'empty ruby text'
+        elif state == IAA:
+            base += 1
+            continue
+        elif state == IAS:
+            ruby += 1
+            continue
+        else:
+            continue
+        state = c
+    if state != IAT:
+        return 'ruby not terminated with IAT (U+FFFB)'
+    return ''
+
+
+# Return the keys to type for text in ime_mode.
+def get_keystrokes(text, reading, ime_mode, roomazi):
+    if ime_mode == 'A':
+        return text.translate(ZENKAKU_TO_HANKAKU).replace('　', ' ')
+    keys = roomazi.hyphenize(roomazi.romanize(reading))
+    return keys.replace('⏎', '\n').replace('　', ' ')
+
+
+# Check the lesson file at path, where each :text is checked as typed in the
+# IME mode in effect at its :start or :random. Return the path, the errors
+# and the warnings as (lineno, message), the :menu and :next targets as
+# (lineno, filename), the plain text, the reading and the key counts of each
+# text, and the key counts of the lesson as a whole.
+def check_lesson(path):
+    errors = list()
+    warnings = list()
+    links = list()
+    texts = dict()
+    total = dict()
+    try:
+        with open(path, 'rb') as file:
+            lines = split_lines(file.read())
+    except (OSError, UnicodeDecodeError) as e:
+        errors.append((0, str(e)))
+        return path, errors, warnings, links, texts, total
+    roomazi = Roomazi()
+    ime_mode = 'A'
+    block = ''      # 'text' or 'hint' while reading the block
+    content = ''
+    start = 0
+    last = ''       # the last :text
+    for lineno, line in enumerate(lines + [':'], 1):
+        if not line.startswith(':'):
+            content += line
+            continue
+        if block:
+            error = check_ruby(content)
+            if error:
+                errors.append((start, error))
+            elif block == 'text':
+                last = content.rstrip()
+        block = content = ''
+        if len(lines) < lineno:
+            break
+        name = line[1:].split(maxsplit=1)[0] if line[1:].strip() else ''
+        argument = line[1 + len(name):].strip()
+        if name not in DIRECTIVES:
+            warnings.append((lineno, "unknown directive ':%s'" % name))
+        elif name in ('text', 'hint'):
+            block = name
+            if name == 'text':
+                last = ''
+            start = lineno + 1
+        elif name == 'ime_mode':
+            ime_mode = argument
+        elif name in ('start', 'random'):
+            if name == 'random':
+                count = len(last.splitlines())
+                if argument and not argument.isdigit():
+                    errors.append((lineno, "':random %s' is not a number" % argument))
+                elif argument and count < int(argument):
+                    errors.append((lineno, "':random %s' exceeds the %d lines of the text" % (argument, count)))
+            if last:
+                _check_text(last, lineno, ime_mode, roomazi, errors, texts, total)
+        elif name == 'menu':
+            links.extend((lineno, target) for target in argument.split() if target not in MENU_COMMANDS)
+        elif name == 'next' and argument:
+            links.append((lineno, argument))
+    return path, errors, warnings, links, texts, total
+
+
+def _check_text(text, lineno, ime_mode, roomazi, errors, texts, total):
+    plain, reading = get_plain_text(text)
+    if ime_mode != 'A':
+        unknown = sorted(set(c for c in reading if c not in roomazi.trie and
+                             c != '　' and not (c.isascii() and c.isprintable())))
+        if unknown:
+            errors.append((lineno, 'no roomazi for %s' % ' '.join(map(repr, unknown))))
+    counts = get_key_counts(reading)
+    counts['kana'] = count_kana_keys(reading, TWO_KEYS)
+    keys = list()
+    for x4063 in (False, True):
+        roomazi.set_x4063(x4063)
+        keys.append(set(get_keystrokes(plain, reading, ime_mode, roomazi)))
+    for name, layout in KEYBOARDS:
+        missing = [sorted(k - layout) for k in keys]
+        for x4063, suffix in ((False, ''), (True, ' with x4063')):
+            if missing[x4063] and (not x4063 or missing[0] != missing[1]):
+                errors.append((lineno, '%s cannot be typed on the %s keyboard%s' %
+                               (' '.join(map(repr, missing[x4063])), name, suffix)))
+    texts[text] = (plain, reading, {name: counts[name] for name in ('roomazi', 'roomazi-x4063')})
+    for name, count in counts.items():
+        total[name] = total.get(name, 0) + count
+
+
+# Return the lesson files in paths, where each directory is searched for the
+# .txt files in it.
+def find_lessons(paths):
+    lessons = list()
+    for path in paths:
+        if not os.path.isdir(path):
+            lessons.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            lessons.extend(os.path.join(dirpath, name) for name in sorted(filenames) if name.endswith('.txt'))
+    return lessons
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check lesson files.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='the number of processes')
+    parser.add_argument('-o', '--output', help='the lesson bundle to write if no errors are found')
+    parser.add_argument('-r', '--root', default=os.curdir, help='the lessons directory to name the lessons from')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the key counts of each lesson')
+    parser.add_argument('lessons', nargs='+', help='the lesson files or directories')
+    args = parser.parse_args()
+
+    paths = find_lessons(args.lessons)
+    known = set(os.path.abspath(path) for path in paths)
+    error_count = 0
+    texts = dict()
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        results = list(executor.map(check_lesson, paths, chunksize=4))
+    for path, errors, warnings, links, lesson_texts, total in results:
+        texts.update(lesson_texts)
+        for lineno, target in links:
+            target_path = os.path.join(os.path.dirname(path), target)
+            if os.path.abspath(target_path) not in known and not os.path.isfile(target_path):
+                errors.append((lineno, '"%s" is not found' % target))
+        for lineno, message in sorted(errors):
+            print('%s:%d: error: %s' % (path, lineno, message))
+        for lineno, message in sorted(warnings):
+            print('%s:%d: warning: %s' % (path, lineno, message))
+        error_count += len(errors)
+        if args.verbose and total:
+            print('%s: roomazi %d keys, roomazi (x4063) %d keys, kana %d keys' %
+                  (path, total['roomazi'], total['roomazi-x4063'], total['kana']))
+    if error_count:
+        print('%d error(s) in %d lesson(s)' % (error_count, len(paths)), file=sys.stderr)
+        return 1
+    if args.output:
+        try:
+            compile_bundle(paths, args.output, texts, args.root)
+        except (OSError, ValueError) as e:
+            print('%s: error: %s' % (args.output, e), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
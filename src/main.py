@@ -14,20 +14,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import startup
+import sys
+
+if '--profile-startup' in sys.argv:
+    sys.argv.remove('--profile-startup')
+    startup.enable()
+
 import package
 
 import gi
 from gi.repository import GLib
 
 GLib.set_prgname(package.get_name())
+startup.mark('import gi')
 
+startup.import_modules(('roomazi', 'keyboard', 'hurigana', 'engine', 'ime', 'imbridge', 'window', 'application'))
 from application import Application
 
 import gettext
 import locale
 import logging
 import os
-import sys
 
 
 logger = logging.getLogger(__name__)
@@ -14,10 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import logging
 
 logger = logging.getLogger(__name__)
 
+MAX_KEY_COUNTS = 1024
+
 KANA_TO_ROOMAZI = {
     "あ": "a",
     "い": "i",
@@ -225,6 +228,34 @@ KANA_TO_ROOMAZI_X4063 = {
     "んの": "n'",
 }
 
+# Spellings accepted by RoomaziMatcher besides the ones in KANA_TO_ROOMAZI
+ALTERNATIVES = {
+    "し": ("shi",),
+    "しゃ": ("sha",),
+    "しゅ": ("shu",),
+    "しょ": ("sho",),
+    "じ": ("ji",),
+    "じゃ": ("ja", "jya"),
+    "じゅ": ("ju", "jyu"),
+    "じょ": ("jo", "jyo"),
+    "ち": ("chi",),
+    "ちゃ": ("cha", "cya"),
+    "ちゅ": ("chu", "cyu"),
+    "ちょ": ("cho", "cyo"),
+    "つ": ("tsu",),
+    "ふ": ("fu",),
+    "りゅ": ("ryu",),
+    "ぁ": ("la",),
+    "ぃ": ("li",),
+    "ぅ": ("lu",),
+    "ぇ": ("le",),
+    "ぉ": ("lo",),
+    "っ": ("ltu", "xtsu", "ltsu"),
+    "ゃ": ("lya",),
+    "ゅ": ("lyu",),
+    "ょ": ("lyo",),
+}
+
 ZENKAKU = "".join(chr(0xff01 + i) for i in range(94))
 HANKAKU = "".join(chr(0x21 + i) for i in range(94))
 
@@ -232,70 +263,253 @@ ZENKAKU_TO_HANKAKU = str.maketrans(ZENKAKU, HANKAKU)
 HANKAKU_TO_ZENKAKU = str.maketrans(HANKAKU, ZENKAKU)
 TO_TYOUON = str.maketrans('aiueo', 'âîûêô')
 TO_PLAIN = str.maketrans('âîûêô', 'aiueo')
+TO_HYPHENIZED = str.maketrans({'â': 'a-', 'î': 'i-', 'û': 'u-', 'ê': 'e-', 'ô': 'o-'})
+
+tries = dict()
+
+
+# Compile the kana to roomazi tables into a trie of up to two characters.
+# Each node is a pair of the roomazi of the character itself and the dict
+# from the next character to the roomazi of the two characters.
+def get_trie(x4063: bool):
+    trie = tries.get(x4063)
+    if trie:
+        return trie
+    table = dict(KANA_TO_ROOMAZI)
+    if x4063:
+        for kana, roomazi in KANA_TO_ROOMAZI_X4063.items():
+            table.setdefault(kana, roomazi)
+    trie = dict()
+    for c in ZENKAKU:
+        trie[c] = (c.translate(ZENKAKU_TO_HANKAKU), dict())
+    trie['\n'] = ('⏎', dict())
+    for kana in sorted(table, key=len):
+        if len(kana) == 1:
+            trie[kana] = (table[kana], dict())
+        else:
+            trie.setdefault(kana[0], (kana[0], dict()))[1][kana[1]] = table[kana]
+    tries[x4063] = trie
+    return trie
+
+
+# Return the end of the kana at s[i] and its roomazi with trie, not
+# including the following 'ー'.
+def get_next(trie, s, i):
+    c = s[i]
+    node = trie.get(c)
+    if not node:
+        return i + 1, c
+    if i + 1 < len(s):
+        roomazi = node[1].get(s[i + 1])
+        if roomazi:
+            if roomazi == "n'":
+                return i + 1, roomazi
+            if c == 'っ':
+                return i + 2, roomazi + trie[s[i + 1]][0]
+            return i + 2, roomazi
+    if c == 'ん' and i + 1 < len(s):
+        next = trie.get(s[i + 1])
+        return i + 2, 'n' + (next[0] if next else s[i + 1])
+    return i + 1, node[0]
+
+
+def get_next_with_tyouon(trie, s, i):
+    end, roomazi = get_next(trie, s, i)
+    if end < len(s) and s[end] == 'ー' and roomazi and roomazi[-1] in 'aiueo':
+        end += 1
+        roomazi = roomazi[:-1] + roomazi[-1].translate(TO_TYOUON)
+    return end, roomazi
+
+
+# Count the keystrokes of the reading in a single pass. The count is
+# memoized by the reading and the x4063 setting, which selects the trie, so
+# that the cache is shared by and does not keep any Roomazi instances.
+@functools.lru_cache(maxsize=MAX_KEY_COUNTS)
+def count_keys(reading: str, x4063: bool):
+    trie = get_trie(x4063)
+    count = 0
+    roomazi = ''
+    i = 0
+    while i < len(reading):
+        i, roomazi = get_next_with_tyouon(trie, reading, i)
+        count += len(roomazi.translate(TO_HYPHENIZED))
+    if roomazi and roomazi[-1] == 'n':
+        count += 1
+    return count
 
 
 class Roomazi:
     def __init__(self):
         self.x4063 = True
+        self.trie = get_trie(self.x4063)
+
+    def _next(self, s, i):
+        return get_next(self.trie, s, i)
 
-    def get_roomazi(self, s):
-        c, r = self.get_roomazi_without_tyouon(s)
-        s = s[len(c):]
-        if s and s[0] == 'ー' and r and r[-1] in 'aiueo':
-            c += 'ー'
-            r = r[:-1] + r[-1].translate(TO_TYOUON)
-        return c, r
+    def _next_with_tyouon(self, s, i):
+        return get_next_with_tyouon(self.trie, s, i)
+
+    def create_matcher(self, reading):
+        return RoomaziMatcher(reading, self.x4063)
+
+    def get_key_count(self, reading):
+        return count_keys(reading, self.x4063)
+
+    def get_roomazi(self, s, i=0):
+        if len(s) <= i:
+            return '', ''
+        end, r = self._next_with_tyouon(s, i)
+        return s[i:end].replace('\n', '⏎'), r
 
     def get_roomazi_without_tyouon(self, s):
         if not s:
             return '', ''
-        p = ''
-        c = ''
-        roomazi = ''
-        if 2 <= len(s):
-            s = s[:2]
-            if s in KANA_TO_ROOMAZI:
-                roomazi = KANA_TO_ROOMAZI[s]
-            elif self.x4063 and s in KANA_TO_ROOMAZI_X4063:
-                roomazi = KANA_TO_ROOMAZI_X4063[s]
-            if roomazi:
-                if roomazi == "n'":
-                    return 'ん', roomazi
-                if s[0] == 'っ':
-                    p = 'っ'
-                    s = s[1:]
-                else:
-                    return s, roomazi
-        c = s[0]
-        if c in KANA_TO_ROOMAZI:
-            roomazi += KANA_TO_ROOMAZI[c]
-            if roomazi == 'n':
-                next = self.get_roomazi(s[1:])
-                c += next[0]
-                roomazi += next[1]
-            return p + c, roomazi
-        if c in ZENKAKU:
-            return c, c.translate(ZENKAKU_TO_HANKAKU)
-        if c == '\n':
-            return '⏎', '⏎'
-        return c, c
+        end, r = self._next(s, 0)
+        return s[:end].replace('\n', '⏎'), r
 
     def hyphenize(self, roomazi):
-        hyphenized = ''
-        for c in roomazi:
-            if c in 'âîûêô':
-                c = c.translate(TO_PLAIN) + '-'
-            hyphenized += c
-        return hyphenized
+        return roomazi.translate(TO_HYPHENIZED)
 
     def romanize(self, s):
-        r = ''
-        while s:
-            pair = self.get_roomazi(s)
-            s = s[len(pair[0]):]
-            r += pair[1]
-        return r
+        r = list()
+        i = 0
+        while i < len(s):
+            i, roomazi = self._next_with_tyouon(s, i)
+            r.append(roomazi)
+        return ''.join(r)
 
     def set_x4063(self, value: bool):
         self.x4063 = value
+        self.trie = get_trie(value)
         logger.info('x4063: %d', value)
+
+
+class MatcherNode:
+    __slots__ = ('children', 'end', 'cost', 'expected')
+
+    def __init__(self):
+        self.children = dict()
+        self.end = -1       # the position in the reading after this spelling
+        self.cost = 0       # the minimum number of the remaining keystrokes
+        self.expected = frozenset()
+
+
+# RoomaziMatcher follows the keystrokes for a reading one by one. The
+# spellings from each position in the reading are compiled into a trie
+# in advance, so each keystroke, the expected next keys and the minimum
+# number of the remaining keystrokes cost O(1).
+class RoomaziMatcher:
+    def __init__(self, reading, x4063=True):
+        self.reading = reading
+        self.x4063 = x4063
+        self.roots = [MatcherNode() for i in range(len(reading) + 1)]
+        spellings = [list() for i in range(len(reading) + 1)]
+        for pos in range(len(reading) - 1, -1, -1):
+            spellings[pos] = self._get_spellings(pos, spellings)
+            root = self.roots[pos]
+            for spelling, end in spellings[pos]:
+                node = root
+                for key in spelling:
+                    node = node.children.setdefault(key, MatcherNode())
+                if node.end < end:
+                    node.end = end
+            self._finish(root)
+        self.pos = 0
+        self.node = self.roots[0]
+        self.typed_count = 0
+        self.miss_count = 0
+
+    def _advance(self, node):
+        self.node = node
+        if not node.children:
+            self.pos = node.end
+            self.node = self.roots[node.end]
+
+    def _finish(self, node):
+        expected = set(node.children)
+        cost = -1
+        if 0 <= node.end:
+            next = self.roots[node.end]
+            expected.update(next.expected)
+            cost = next.cost
+        for child in node.children.values():
+            self._finish(child)
+            if cost < 0 or 1 + child.cost < cost:
+                cost = 1 + child.cost
+        node.cost = max(0, cost)
+        node.expected = frozenset(expected)
+
+    def _get_spellings(self, pos, spellings):
+        reading = self.reading
+        c = reading[pos]
+        result = list()
+        if pos + 1 < len(reading):
+            kana = reading[pos:pos + 2]
+            if kana in ALTERNATIVES or (kana in KANA_TO_ROOMAZI and c not in 'っん'):
+                for spelling in self._get_kana_spellings(kana):
+                    result.append((spelling, pos + 2))
+        if c == 'ん':
+            result.append(("n'", pos + 1))
+            next = spellings[pos + 1]
+            if self.x4063 or not next:
+                result.append(('nn', pos + 1))
+            avoid = 'aiueoyn' if self.x4063 else 'aiueoy'
+            if next and all(spelling[0] not in avoid for spelling, end in next):
+                result.append(('n', pos + 1))
+        elif c == 'っ':
+            for spelling in self._get_kana_spellings(c):
+                result.append((spelling, pos + 1))
+            for spelling in set(spelling[0] for spelling, end in spellings[pos + 1]):
+                if spelling.isalpha() and spelling not in 'aiueon':
+                    result.append((spelling, pos + 1))
+        elif c in KANA_TO_ROOMAZI or c in ALTERNATIVES:
+            for spelling in self._get_kana_spellings(c):
+                result.append((spelling, pos + 1))
+        elif c == '\u3000':
+            result.append((' ', pos + 1))
+        else:
+            result.append((c.translate(ZENKAKU_TO_HANKAKU), pos + 1))
+        return result
+
+    def _get_kana_spellings(self, kana):
+        spellings = list(ALTERNATIVES.get(kana, ()))
+        if kana in KANA_TO_ROOMAZI and kana != "ゆゅ":
+            spellings.insert(0, KANA_TO_ROOMAZI[kana])
+        return spellings
+
+    # Return the keys that can be typed next.
+    def expected(self):
+        return self.node.expected
+
+    # Advance the matcher by key and return True if key is expected.
+    def feed(self, key):
+        self.typed_count += 1
+        child = self.node.children.get(key)
+        if child:
+            self._advance(child)
+            return True
+        if 0 <= self.node.end:
+            # key begins the next kana.
+            child = self.roots[self.node.end].children.get(key)
+            if child:
+                self.pos = self.node.end
+                self._advance(child)
+                return True
+        self.miss_count += 1
+        return False
+
+    def get_miss_count(self):
+        return self.miss_count
+
+    def get_position(self):
+        return self.pos
+
+    def get_typed_count(self):
+        return self.typed_count
+
+    def is_done(self):
+        return len(self.reading) <= self.pos
+
+    # Return the minimum number of the keystrokes to finish the reading.
+    def remaining(self):
+        return self.node.cost
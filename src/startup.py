@@ -0,0 +1,65 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import importlib
+import sys
+import time
+
+# Startup profiling enabled by the --profile-startup option. The report
+# lists the time of each phase since the start of main.py and since the
+# previous phase, ending with the first frame of the window.
+enabled = False
+start_time = time.perf_counter()
+marks = list()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def import_modules(names):
+    if not enabled:
+        return
+    for name in names:
+        importlib.import_module(name)
+        mark('import ' + name)
+
+
+def mark(phase):
+    if enabled:
+        marks.append((phase, time.perf_counter()))
+
+
+def report():
+    print('   total    phase', file=sys.stderr)
+    last = start_time
+    for phase, t in marks:
+        print('{:6.1f}ms {:6.1f}ms  {}'.format((t - start_time) * 1000, (t - last) * 1000, phase), file=sys.stderr)
+        last = t
+
+
+def watch_first_frame(widget):
+    if not enabled:
+        return
+
+    def on_draw(widget, ctx):
+        widget.disconnect(handler)
+        mark('first frame')
+        report()
+
+    handler = widget.connect_after('draw', on_draw)
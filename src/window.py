@@ -22,17 +22,20 @@ gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
 from gi.repository import Gio, GLib, Gtk, Gdk, Pango, PangoCairo
 
-from chart import Chart
 from engine import Engine, EngineMode, Stats
-from hurigana import HuriganaLayout
+from hurigana import HuriganaCache
+from imbridge import IMBridge
 import ime
 from keyboard import Keyboard
 from roomazi import Roomazi
+import startup
 
 import cairo
 from datetime import date
+import functools
 import gettext
 import logging
+import math
 import os
 
 
@@ -58,15 +61,45 @@ MARGIN_TOP = (WINDOW_HEIGHT - HEIGHT) / 2
 MARGIN_BOTTOM = MARGIN_TOP
 STOPWATCH_WIDTH = 80
 STOPWATCH_HEIGHT = 18
+STOPWATCH_X = WINDOW_WIDTH - MARGIN_RIGHT - STOPWATCH_WIDTH
+STOPWATCH_Y = WINDOW_HEIGHT - MARGIN_BOTTOM - STOPWATCH_HEIGHT
 CHART_WIDTH = WIDTH
 CHART_HEIGHT = 400
 PRACTICE_CENTER = MARGIN_LEFT + (MARGIN_RIGHT + 600) / 2
+TICK_RATE = 10  # [Hz]
+MENU_DETAIL_SIZE = 12
+MENU_DETAIL_X = MARGIN_LEFT + WIDTH + 10
+
+KEYBOARD_X = MARGIN_LEFT + MARGIN_RIGHT / 2
+KEYBOARD_Y = WINDOW_HEIGHT - 256
+
+# Areas to be invalidated during practice as (x, y, width, height). The
+# stopwatch area must not overlap with the keyboard drawn above it.
+STOPWATCH_AREA = (int(STOPWATCH_X), int(STOPWATCH_Y) - FONT_SIZE + 1, 2 * STOPWATCH_WIDTH, FONT_SIZE + 6)
+PRACTICE_AREA = (int(MARGIN_LEFT) - 5, 0, int(WINDOW_WIDTH - MARGIN_LEFT) + 5, WINDOW_HEIGHT)
+# The keyboard and the key to type under it
+KEYBOARD_AREA = (int(KEYBOARD_X) + Keyboard.IMAGE_LEFT, KEYBOARD_Y + Keyboard.IMAGE_TOP,
+                 Keyboard.IMAGE_WIDTH, Keyboard.IMAGE_HEIGHT)
+# Text to load the fonts with before the first lesson
+WARM_UP_TEXT = "Aa0あアー亜、。"
 
 
 def get_title():
     return _("Typing Practice")
 
 
+def contains(area, rect):
+    x, y, w, h = area
+    return (x <= rect.x and rect.x + rect.width <= x + w and
+            y <= rect.y and rect.y + rect.height <= y + h)
+
+
+def intersects(area, rect):
+    x, y, w, h = area
+    return (rect.x < x + w and x < rect.x + rect.width and
+            rect.y < y + h and y < rect.y + rect.height)
+
+
 def get_prefix(s1, s2):
     i = 0
     while i < min(len(s1), len(s2)):
@@ -82,6 +115,10 @@ class View(Gtk.DrawingArea):
         Gtk.DrawingArea.__init__(self)
 
         self.caret = Gdk.Rectangle()
+        self.drawn = None   # (mode, text) of the last full frame
+        self.tick_id = 0
+        self.stopwatch = ''     # the stopwatch text drawn last
+        self.set_tick_rate(TICK_RATE)
 
         self.connect("draw", self.on_draw)
         self.connect("key-press-event", self.on_key_press)
@@ -89,7 +126,7 @@ class View(Gtk.DrawingArea):
         self.connect("focus-in-event", self.on_focus_in)
         self.connect("focus-out-event", self.on_focus_out)
 
-        self.im_context = Gtk.IMMulticontext()
+        self.im_context = ime.create_context(self)
         self.im_context.set_client_window(self.get_window())
         self.im_context.connect("commit", self.on_commit)
         self.im_context.connect("delete-surrounding", self.on_delete_surrounding)
@@ -97,12 +134,16 @@ class View(Gtk.DrawingArea):
         self.im_context.connect("preedit-changed", self.on_preedit_changed)
         self.im_context.connect("preedit-end", self.on_preedit_end)
         self.im_context.connect("preedit-start", self.on_preedit_start)
+        self.im_bridge = IMBridge(self.im_context)
 
         self.set_can_focus(True)
 
+        self.layouts = HuriganaCache()
+        self.warm_up = None     # the warm-up steps left
+        self.menu_details = (None, None)    # (key, the details of each lesson in the menu)
         self.roomazi = Roomazi()
         self.keyboard = Keyboard(self.roomazi)
-        self.engine = Engine(self.roomazi)
+        self.engine = Engine(self.roomazi, self.queue_draw)
 
     def _clear(self, wid, ctx):
         width = wid.get_allocated_width()
@@ -126,9 +167,7 @@ class View(Gtk.DrawingArea):
         ctx.fill()
         ctx.restore()
         x, y = self.translate_coordinates(self.get_toplevel(), self.caret.x, self.caret.y)
-        self.caret.x = x
-        self.caret.y = y
-        self.im_context.set_cursor_location(self.caret)
+        self.im_bridge.set_cursor_location(x, y, self.caret.width, self.caret.height)
 
     def _draw_hints(self, wid, ctx: cairo.Context, hint):
         hint = self.engine.markup(hint)
@@ -140,29 +179,52 @@ class View(Gtk.DrawingArea):
         ctx.stroke()
 
         ctx.set_source_rgb(0, 0, 0)
-        hurigana = HuriganaLayout(ctx)
-        hurigana.set_ruby_size(HINT_SIZE / 2.5)
-        desc = Pango.font_description_from_string(HINT_FONT)
-        hurigana.set_font_description(desc)
-        hurigana.set_width(MARGIN_LEFT - 30)
-        hurigana.set_spacing(HINT_SPACING)
-        hurigana.set_markup(hint)
+        hurigana = self.layouts.get(ctx, hint, HINT_FONT, MARGIN_LEFT - 30, HINT_SPACING,
+                                    ruby_size=HINT_SIZE / 2.5, markup=True)
         hurigana.draw(10, MARGIN_TOP)
 
     def _draw_menu(self, wid, ctx):
         # Draw text
-        hurigana = HuriganaLayout(ctx)
-        hurigana.set_ruby_size(FONT_SIZE / 2.5)
-        desc = Pango.font_description_from_string(DEFAULT_FONT)
-        hurigana.set_font_description(desc)
-        hurigana.set_width(WIDTH)
-        hurigana.set_spacing(LINE_SPACING)
         markup = self.engine.markup(self.engine.get_text())
-        hurigana.set_markup(markup)
+        hurigana = self.layouts.get(ctx, markup, DEFAULT_FONT, WIDTH, LINE_SPACING,
+                                    ruby_size=FONT_SIZE / 2.5, markup=True)
         hurigana.draw(MARGIN_LEFT, MARGIN_TOP)
 
+        self._draw_menu_details(ctx, hurigana)
         self._draw_hints(wid, ctx, self.engine.get_hint())
 
+    # Show the length, the estimated key count and the best score of each
+    # lesson in the menu to the right of the menu line that starts with its
+    # number.
+    def _draw_menu_details(self, ctx, hurigana):
+        menu = self.engine.get_menu()
+        lines = dict()  # the offset of each line in the menu text by its first word
+        offset = 0
+        for line in hurigana.plain.splitlines(True):
+            words = line.split(maxsplit=1)
+            if words and words[0] not in lines:
+                lines[words[0]] = offset + len(line) - len(line.lstrip())
+            offset += len(line)
+        ctx.save()
+        ctx.select_font_face("Noto Sans Mono CJK JP", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        ctx.set_font_size(MENU_DETAIL_SIZE)
+        for n, (name, detail) in enumerate(zip(menu, self._get_menu_details(menu))):
+            offset = lines.get(str((n + 1) % 10))
+            if offset is None:
+                continue
+            x, y, width, height = hurigana.get_char_pos(offset)
+            y += MARGIN_TOP + (height - 2 * MENU_DETAIL_SIZE) / 2
+            if detail:
+                ctx.set_source_rgb(0x66 / 255, 0x66 / 255, 0x66 / 255)
+                ctx.move_to(MENU_DETAIL_X, y + MENU_DETAIL_SIZE)
+                ctx.show_text(detail)
+            score = self.engine.get_best_score(name)
+            if score:
+                ctx.set_source_rgb(0xff / 255, 0xcc / 255, 0x33 / 255)
+                ctx.move_to(MENU_DETAIL_X, y + 2 * MENU_DETAIL_SIZE + 2)
+                ctx.show_text("★" * min(score, 6))
+        ctx.restore()
+
     if Pango.version_check(1, 44, 0) is None:
 
         def _draw_typed(self, ctx, layout, hurigana):
@@ -249,21 +311,22 @@ class View(Gtk.DrawingArea):
             PangoCairo.show_layout(ctx, layout)
             return layout, typed
 
-    def _draw_practice(self, wid, ctx):
+    def _draw_practice(self, wid, ctx, clip):
         ctx.select_font_face("Noto Sans Mono CJK JP", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
         ctx.set_font_size(FONT_SIZE)
 
+        # Timer ticks only invalidate the stopwatch.
+        if contains(STOPWATCH_AREA, clip):
+            self._draw_stopwatch(ctx)
+            return
+
         x = MARGIN_LEFT
         y = MARGIN_TOP
-        desc = Pango.font_description_from_string(DEFAULT_FONT)
 
         # Draw text for practicing.
-        hurigana = HuriganaLayout(ctx)
-        hurigana.set_font_description(desc)
-        hurigana.set_width(WIDTH)
-        hurigana.set_spacing(PRACTICE_LINE_SPACING)
-        hurigana.set_text(self.engine.get_text())
+        hurigana = self.layouts.get(ctx, self.engine.get_text(), DEFAULT_FONT, WIDTH, PRACTICE_LINE_SPACING)
         hurigana.draw(x, y)
+        desc = hurigana.font_description
 
         # Draw what has been typed.
         y += LINE_HEIGHT
@@ -283,10 +346,9 @@ class View(Gtk.DrawingArea):
         # Draw keyboard:
         if self.engine.get_show_keyboard():
             text = self.engine.get_text()
-            current = get_prefix(text, self.engine.get_typed())
-            if len(current) <= len(text):
-                current = text[len(current):]
-            pair = self.keyboard.draw(ctx, x + MARGIN_RIGHT / 2, WINDOW_HEIGHT - 256, current)
+            plan = self.keyboard.get_plan(text)
+            offset = len(get_prefix(text, self.engine.get_typed()))
+            pair = self.keyboard.draw(ctx, KEYBOARD_X, KEYBOARD_Y, plan, offset)
             if pair[0]:
                 ctx.set_source_rgb(0, 0, 0)
                 t = pair[0]
@@ -294,20 +356,19 @@ class View(Gtk.DrawingArea):
                     t += ' [' + pair[1] + ']'
                 self._show_centered_text(ctx, t, PRACTICE_CENTER, WINDOW_HEIGHT - MARGIN_BOTTOM - STOPWATCH_HEIGHT)
 
-        # Show stopwatch
-        ctx.set_source_rgb(0, 0, 0)
-        elapsed = self.engine.get_duration()
-        ctx.move_to(WINDOW_WIDTH - MARGIN_RIGHT - STOPWATCH_WIDTH,
-                    WINDOW_HEIGHT - MARGIN_BOTTOM - STOPWATCH_HEIGHT)
-        ctx.show_text("[{:4d}] {:02d}:{:04.1f}".format(
-            self.engine.get_touch_count(),
-            int(elapsed / 60),
-            elapsed % 60))
+        self._draw_stopwatch(ctx)
 
-        hint = self.engine.get_hint()
-        if not hint:
-            hint = "<kbd>Esc</kbd> メニューにもどる"
-        self._draw_hints(wid, ctx, hint)
+        if not contains(PRACTICE_AREA, clip):
+            hint = self.engine.get_hint()
+            if not hint:
+                hint = "<kbd>Esc</kbd> メニューにもどる"
+            self._draw_hints(wid, ctx, hint)
+
+    def _draw_stopwatch(self, ctx):
+        ctx.set_source_rgb(0, 0, 0)
+        ctx.move_to(STOPWATCH_X, STOPWATCH_Y)
+        self.stopwatch = self._get_stopwatch_text()
+        ctx.show_text(self.stopwatch)
 
     def _draw_score(self, wid, ctx):
         ctx.select_font_face("Noto Sans Mono CJK JP", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
@@ -346,13 +407,7 @@ class View(Gtk.DrawingArea):
             self.engine.get_cpm(), self.engine.get_wpm(),
             len(self.engine.get_plain()) * 60 / duration,
             self.engine.get_error_ratio() * 100)
-        hurigana = HuriganaLayout(ctx)
-        hurigana.set_ruby_size(FONT_SIZE / 2.5)
-        desc = Pango.font_description_from_string(DEFAULT_FONT)
-        hurigana.set_font_description(desc)
-        hurigana.set_width(WIDTH)
-        hurigana.set_spacing(LINE_SPACING)
-        hurigana.set_text(text)
+        hurigana = self.layouts.get(ctx, text, DEFAULT_FONT, WIDTH, LINE_SPACING, ruby_size=FONT_SIZE / 2.5)
         hurigana.draw(x, y)
 
         hint = "<kbd>Enter</kbd> つぎにすすむ\n<kbd>Backspace</kbd> もういちど\n<kbd>Esc</kbd> メニューにもどる"
@@ -376,6 +431,7 @@ class View(Gtk.DrawingArea):
         x = MARGIN_LEFT + 50
         y = 2 * LINE_HEIGHT
 
+        from chart import Chart
         chart = Chart(ctx, x, y, CHART_WIDTH, CHART_HEIGHT)
         ctx.set_source_rgb(0xcc / 255, 0xcc / 255, 0xcc / 255)
         step = WIDTH / period
@@ -396,13 +452,8 @@ class View(Gtk.DrawingArea):
         self._show_aligned_text(ctx, str(max_wpm) + ' WPM', 0.2, 0.5)
 
         notes = ' <span foreground="#00CC33">ー ￹正確￺せいかく￻さ</span>\n <span foreground="#FF6600">ー WPM</span>'
-        hurigana = HuriganaLayout(ctx)
-        hurigana.set_ruby_size(FONT_SIZE / 2.5)
-        desc = Pango.font_description_from_string(DEFAULT_FONT)
-        hurigana.set_font_description(desc)
-        hurigana.set_width(MARGIN_RIGHT)
-        hurigana.set_spacing(LINE_SPACING)
-        hurigana.set_markup(notes)
+        hurigana = self.layouts.get(ctx, notes, DEFAULT_FONT, MARGIN_RIGHT, LINE_SPACING,
+                                    ruby_size=FONT_SIZE / 2.5, markup=True)
         hurigana.draw(x + CHART_WIDTH, y + CHART_HEIGHT - 3 * LINE_HEIGHT)
 
         # WPM
@@ -425,6 +476,34 @@ class View(Gtk.DrawingArea):
 
         self._draw_hints(wid, ctx, '<kbd>Esc</kbd> もどる\n<kbd>F2</kbd> きろくのリセット')
 
+    # Return the length and the estimated key count of each lesson in menu.
+    # They are computed again only when a lesson in the catalog, the layout
+    # or the x4063 setting has changed. The key counts are left out until the
+    # keyboard layout is loaded, not to load it just to show a menu.
+    def _get_menu_details(self, menu):
+        infos = tuple(self.engine.get_lesson_info(name) if name not in ('stats', 'up', 'quit') else None
+                      for name in menu)
+        model = self.keyboard.get_loaded_model()
+        key = (infos, model, self.roomazi.x4063)
+        if self.menu_details[0] != key:
+            details = list()
+            for info in infos:
+                if not info or info.menu:
+                    details.append('')
+                elif model:
+                    details.append("{:d}もじ {:d}タッチ".format(info.size, self.keyboard.get_key_count(info.reading, info.counts)))
+                else:
+                    details.append("{:d}もじ".format(info.size))
+            self.menu_details = (key, details)
+        return self.menu_details[1]
+
+    def _get_stopwatch_text(self):
+        elapsed = self.engine.get_duration()
+        return "[{:4d}] {:02d}:{:04.1f}".format(
+            self.engine.get_touch_count(),
+            int(elapsed / 60),
+            elapsed % 60)
+
     def _show_aligned_text(self, ctx: cairo.Context, text, x, y):
         extents = ctx.text_extents(text)
         ctx.rel_move_to(x * extents.width, y * extents.height)
@@ -435,50 +514,140 @@ class View(Gtk.DrawingArea):
         ctx.move_to(x - extents.width / 2, y)
         ctx.show_text(text)
 
+    # Return the area of the typed line with the caret drawn last, extended by
+    # the lines before and after it.
+    def _get_line_area(self, before, after):
+        pitch = self.caret.height + PRACTICE_LINE_SPACING
+        y = self.caret.y - before * pitch - 5
+        h = self.caret.height + (before + after) * pitch + 10
+        return PRACTICE_AREA[0], int(y), int(WIDTH) + 10, int(math.ceil(h))
+
+    # Return the mode and the text of the screen to draw. While a lesson is
+    # loading, the last screen is kept.
+    def _get_screen(self):
+        mode = self.engine.get_mode()
+        if mode == EngineMode.LOADING and self.drawn:
+            mode = self.drawn[0]
+        return mode, self.engine.get_text()
+
+    # Redraw the typed line and the keyboard after typing, leaving the hint
+    # panel and the rest of the text as they are. The lines before and after
+    # the caret are redrawn as well for deleting and inserting text that may
+    # cross a line. The whole window is redrawn if the screen is about to
+    # change, e.g., when the practice has been finished.
+    def _queue_draw_practice(self, before=0, after=1):
+        self.engine.run(self.keyboard)
+        if (not self.engine.is_practice_mode() or self._get_screen() != self.drawn or
+                not self.caret.height):
+            self.queue_draw()
+            return
+        self.queue_draw_area(*self._get_line_area(before, after))
+        if self.engine.get_show_keyboard():
+            self.queue_draw_area(*KEYBOARD_AREA)
+
+    # Tick at TICK_RATE only while the stopwatch is running.
+    def _start_ticks(self):
+        if not self.tick_id:
+            self.tick_id = GLib.timeout_add(self.tick_interval, self.on_tick)
+
+    # Warm up the fonts, the keyboard and the lessons in the menu and in its
+    # submenus one at a time while the app is idle after the menu has been
+    # shown.
+    def _start_warm_up(self):
+        self.warm_up = [self._warm_up_fonts,
+                        functools.partial(self.keyboard.warm_up, self.get_scale_factor()),
+                        self.engine.get_stats]
+        for name in self.engine.get_menu_lessons_to_preload():
+            self.warm_up.append(functools.partial(self.engine.preload, name, self.keyboard))
+        GLib.idle_add(self.on_warm_up, priority=GLib.PRIORITY_LOW)
+
+    def _stop_ticks(self):
+        if self.tick_id:
+            GLib.source_remove(self.tick_id)
+            self.tick_id = 0
+
+    def _warm_up_fonts(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+        ctx = cairo.Context(surface)
+        ctx.select_font_face("Noto Sans Mono CJK JP", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        ctx.set_font_size(FONT_SIZE)
+        ctx.text_extents(WARM_UP_TEXT)
+        layout = PangoCairo.create_layout(ctx)
+        layout.set_text(WARM_UP_TEXT, -1)
+        for font in (DEFAULT_FONT, HINT_FONT):
+            layout.set_font_description(Pango.font_description_from_string(font))
+            layout.get_pixel_extents()
+
     def get_engine(self):
         return self.engine
 
     def on_commit(self, im, str):
         self.engine.append(str)
-        self.queue_draw()
+        self._queue_draw_practice()
 
     def on_delete_surrounding(self, im, offset, n_chars):
         self.engine.delete(offset, n_chars, reset=False)
-        self.queue_draw()
+        self._queue_draw_practice(before=1)
         return True
 
     def on_draw(self, wid, ctx: cairo.Context):
-        if self.engine.run(self.keyboard):
-            GLib.timeout_add(100, self.timeout)
+        self.engine.run(self.keyboard)
         if self.engine.get_mode() == EngineMode.EXIT:
+            self._stop_ticks()
             self.get_toplevel().destroy()
             return
+        if self.engine.is_practice_mode() and self.engine.is_started():
+            self._start_ticks()
+        elif self.tick_id:
+            self._stop_ticks()
+            if not self.engine.is_practice_mode():
+                self.im_context.reset()
+
+        drawn = self._get_screen()
+        mode = drawn[0]
+        clip = Gdk.cairo_get_clip_rectangle(ctx)[1]
+        if drawn != self.drawn:
+            if (0 < clip.x or 0 < clip.y or
+                    clip.x + clip.width < wid.get_allocated_width() or
+                    clip.y + clip.height < wid.get_allocated_height()):
+                # The screen has changed since the last full frame. Draw the
+                # whole new screen into the clip now, and the rest next.
+                clip = Gdk.Rectangle()
+                clip.width = wid.get_allocated_width()
+                clip.height = wid.get_allocated_height()
+                self.queue_draw()
+            self.drawn = drawn
 
         title = self.engine.get_title()
         if title:
             title += " – " + get_title()
         else:
             title = get_title()
-        self.get_toplevel().set_title(title)
+        if self.engine.get_profile():
+            title += " (" + self.engine.get_profile() + ")"
+        if title != self.get_toplevel().get_title():
+            self.get_toplevel().set_title(title)
 
         self._clear(wid, ctx)
-        if self.engine.get_mode() == EngineMode.SCORE:
+        if mode == EngineMode.SCORE:
             self._draw_score(wid, ctx)
-        elif self.engine.get_mode() == EngineMode.PRACTICE:
-            self._draw_practice(wid, ctx)
-        elif self.engine.get_mode() == EngineMode.MENU:
+        elif mode == EngineMode.PRACTICE:
+            self._draw_practice(wid, ctx, clip)
+        elif mode == EngineMode.MENU:
             self._draw_menu(wid, ctx)
-        elif self.engine.get_mode() == EngineMode.STATS:
+            if self.warm_up is None:
+                self._start_warm_up()
+        elif mode == EngineMode.STATS:
             self._draw_stats(wid, ctx)
 
     def on_focus_in(self, wid, event):
         ime.check_engine()
         ime.set_mode(self.get_engine().get_ime_mode())
-        self.im_context.focus_in()
+        self.im_bridge.focus_in()
         return True
 
     def on_focus_out(self, wid, event):
-        self.im_context.focus_out()
+        self.im_bridge.focus_out()
         ime.restore_engine()
         return True
 
@@ -502,7 +671,7 @@ class View(Gtk.DrawingArea):
             return True
         if event.keyval == Gdk.KEY_BackSpace:
             self.engine.backspace()
-            self.queue_draw()
+            self._queue_draw_practice(before=1)
             return True
         if event.keyval == Gdk.KEY_Return:
             self.engine.enter(self.keyboard)
@@ -527,34 +696,64 @@ class View(Gtk.DrawingArea):
 
     def on_preedit_changed(self, im):
         self.engine.set_preedit(self.im_context.get_preedit_string())
-        self.queue_draw()
+        self._queue_draw_practice(before=1)
         return False
 
     def on_preedit_end(self, im):
         self.engine.set_preedit(self.im_context.get_preedit_string())
-        self.queue_draw()
+        self._queue_draw_practice(before=1)
         return False
 
     def on_preedit_start(self, im):
         self.engine.set_preedit(self.im_context.get_preedit_string())
-        self.queue_draw()
+        self._queue_draw_practice()
         return False
 
     def on_retrieve_surrounding(self, im):
         if self.engine.is_practice_mode():
-            typed = self.engine.get_typed()
-            length = len(typed.encode())
-            self.im_context.set_surrounding(typed, length, length)
+            self.im_bridge.set_surrounding(self.engine.get_typed())
         else:
-            self.im_context.set_surrounding('', 0, 0)
+            self.im_bridge.set_surrounding('')
         return True
 
-    def timeout(self):
+    # Runs at TICK_RATE only while the stopwatch is running, including the
+    # delay before the score is shown.
+    def on_tick(self):
+        if self.engine.is_practice_mode() and self.engine.is_started():
+            # Redraw the stopwatch only when its text changes. Once finished,
+            # let the engine go on, and redraw the whole window when it shows
+            # the score.
+            if self.engine.is_finished(no_wait=True):
+                self.engine.run(self.keyboard)
+                if self._get_screen() != self.drawn:
+                    self.queue_draw()
+                    return GLib.SOURCE_CONTINUE
+                self.queue_draw_area(*STOPWATCH_AREA)
+            elif self._get_stopwatch_text() != self.stopwatch:
+                self.queue_draw_area(*STOPWATCH_AREA)
+            return GLib.SOURCE_CONTINUE
+        self.tick_id = 0
         self.queue_draw()
-        if self.engine.is_practice_mode():
-            return True
-        self.im_context.reset()
-        return False
+        if not self.engine.is_practice_mode():
+            self.im_context.reset()
+        return GLib.SOURCE_REMOVE
+
+    def on_warm_up(self):
+        if self.warm_up:
+            self.warm_up.pop(0)()
+        if self.warm_up:
+            return GLib.SOURCE_CONTINUE
+        logger.info('warmed up')
+        # Show the lesson info and the best scores gathered meanwhile.
+        self.queue_draw()
+        return GLib.SOURCE_REMOVE
+
+    def set_tick_rate(self, rate):
+        self.tick_interval = 1000 // rate  # [milliseconds]
+        if self.tick_id:
+            GLib.source_remove(self.tick_id)
+            self.tick_id = 0
+            self._start_ticks()
 
 
 class TypingWindow(Gtk.ApplicationWindow):
@@ -585,12 +784,18 @@ class TypingWindow(Gtk.ApplicationWindow):
         action = Gio.SimpleAction.new("menu", None)
         action.connect("activate", self.menu_callback)
         self.add_action(action)
+        action = Gio.SimpleAction.new("profile", None)
+        action.connect("activate", self.profile_callback)
+        self.add_action(action)
 
         self.view = View()
         self.engine = self.view.get_engine()
         self.add(self.view)
+        startup.mark('view')
         if filename:
             self.open(filename)
+            startup.mark('lesson')
+        startup.watch_first_frame(self.view)
         self.show_all()
 
     def __del__(self):
@@ -603,6 +808,27 @@ class TypingWindow(Gtk.ApplicationWindow):
     def open(self, filename):
         self.engine.open(filename)
 
+    def profile_callback(self, *whatever):
+        dialog = Gtk.Dialog(title=_("Switch Profile"), transient_for=self, modal=True)
+        dialog.add_buttons(_("_Cancel"), Gtk.ResponseType.CANCEL, _("_OK"), Gtk.ResponseType.OK)
+        dialog.set_default_response(Gtk.ResponseType.OK)
+        combo = Gtk.ComboBoxText.new_with_entry()
+        for name in self.engine.get_profiles().get_names():
+            combo.append_text(name)
+        entry = combo.get_child()
+        entry.set_text(self.engine.get_profile())
+        entry.set_placeholder_text(_("Default"))
+        entry.set_activates_default(True)
+        box = dialog.get_content_area()
+        box.set_border_width(10)
+        box.add(combo)
+        dialog.show_all()
+        response = dialog.run()
+        name = entry.get_text()
+        dialog.destroy()
+        if response == Gtk.ResponseType.OK and self.engine.set_profile(name):
+            self.view.queue_draw()
+
     def quit(self):
         logger.info('TypingWindow.quit')
         self.engine.quit()
@@ -0,0 +1,69 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run in the source tree after configure and make, where src/package.py
+# has been generated:
+#
+#   python3 -m pytest tests
+
+from datetime import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+pytest.importorskip('gi')
+package = pytest.importorskip('package')
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(package, 'get_user_datadir', lambda: str(tmp_path))
+    from engine import Engine
+    from roomazi import Roomazi
+    engine = Engine(Roomazi())
+    yield engine
+    engine.quit()
+
+
+def test_get_stats(engine, tmp_path):
+    now = datetime.now()
+    with open(os.path.join(tmp_path, 'stats.txt'), 'w') as file:
+        file.write('{},"menu.txt",01:00.0,300,320\n'.format(now.strftime('%Y-%m-%d %H:%M:%S')))
+    stats = engine.get_stats()
+    assert stats is engine.get_stats()
+    assert stats.get_stats() == [(now.date(), 60.0, 60, 0.94)]
+    assert stats.get_best_score('menu.txt') == engine.get_best_score(os.path.join(engine.lessons_dir, 'menu.txt'))
+
+
+def test_get_best_score_by_path(engine, tmp_path):
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with open(os.path.join(tmp_path, 'stats.txt'), 'w') as file:
+        file.write('{},"a/x.txt",01:00.0,300,300\n'.format(now))
+        file.write('{},"b/x.txt",01:00.0,60,300\n'.format(now))
+    engine.get_stats()
+    a = engine.get_best_score(os.path.join(engine.lessons_dir, 'a', 'x.txt'))
+    b = engine.get_best_score(os.path.join(engine.lessons_dir, 'b', 'x.txt'))
+    assert a and b and b < a
+    assert engine.get_best_score(os.path.join(engine.lessons_dir, 'x.txt')) is None
+
+
+def test_get_stats_of_profile(engine, tmp_path):
+    assert engine.set_profile('student')
+    assert engine.get_stats().get_stats() == list()
+    assert os.path.isfile(os.path.join(tmp_path, 'profiles', 'student', 'stats.txt'))
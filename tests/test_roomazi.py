@@ -0,0 +1,97 @@
+# typing-practice - Typing Practice
+#
+# Copyright (c) 2020-2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import os
+import sys
+import weakref
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from roomazi import ALTERNATIVES, Roomazi, RoomaziMatcher, count_keys
+
+
+def feed(matcher, keys):
+    return [matcher.feed(key) for key in keys]
+
+
+def test_exact_input():
+    matcher = RoomaziMatcher('かな')
+    assert matcher.remaining() == 4
+    assert feed(matcher, 'kana') == [True] * 4
+    assert matcher.is_done()
+    assert matcher.get_typed_count() == 4
+    assert matcher.get_miss_count() == 0
+
+
+def test_wrong_key():
+    matcher = RoomaziMatcher('かな')
+    assert feed(matcher, 'kx') == [True, False]
+    assert matcher.get_position() == 0
+    assert 'a' in matcher.expected()
+    assert feed(matcher, 'ana') == [True] * 3
+    assert matcher.is_done()
+    assert matcher.get_typed_count() == 5
+    assert matcher.get_miss_count() == 1
+
+
+@pytest.mark.parametrize('reading, keys', [
+    ('しゃしん', 'syasinn'),
+    ('しゃしん', 'shashinn'),
+    ('じゃ', 'zya'),
+    ('じゃ', 'ja'),
+    ('じゃ', 'jya'),
+    ('ちゃ', 'cha'),
+    ('つ', 'tsu'),
+    ('っち', 'tti'),
+    ('っち', 'cchi'),
+    ('っち', 'ltuti'),
+])
+def test_alternatives(reading, keys):
+    matcher = RoomaziMatcher(reading)
+    assert feed(matcher, keys) == [True] * len(keys)
+    assert matcher.is_done()
+    assert matcher.get_miss_count() == 0
+
+
+@pytest.mark.parametrize('kana, spellings', sorted(ALTERNATIVES.items()))
+def test_all_alternatives(kana, spellings):
+    for spelling in spellings:
+        matcher = RoomaziMatcher(kana)
+        feed(matcher, spelling)
+        assert matcher.is_done(), spelling
+        assert matcher.get_miss_count() == 0
+
+
+def test_get_miss_count():
+    matcher = RoomaziMatcher('かな')
+    assert feed(matcher, 'qkqaqnqa') == [False, True, False, True, False, True, False, True]
+    assert matcher.is_done()
+    assert matcher.get_miss_count() == 4
+    assert matcher.get_typed_count() == 8
+
+
+def test_get_key_count():
+    roomazi = Roomazi()
+    assert roomazi.get_key_count('しゃしん') == count_keys('しゃしん', True) == 7
+    roomazi.set_x4063(False)
+    assert roomazi.get_key_count('しゃしん') == count_keys('しゃしん', False)
+    ref = weakref.ref(roomazi)
+    del roomazi
+    gc.collect()
+    assert ref() is None